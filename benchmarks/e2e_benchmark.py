@@ -0,0 +1,310 @@
+"""Сквозной замер пересылки без сети: локальная страница-имитация MAX и заглушка Bot API.
+
+Страница добавляет сообщения с заданной частотой, в текст каждого записывается
+номер и время вставки ("bench: #N @<мс>"). Заглушка sendMessage разбирает
+пришедшие тексты (в том числе склеенные) и считает задержку от вставки на
+странице до получения. Итог: задержка p50/p95/p99, устойчивая скорость,
+повторные доставки одного сообщения и CPU/RSS бота и браузера.
+
+Сообщение на странице — элемент с вложенным элементом текста, как в MAX: в режиме
+опроса (--capture poll) сканирование находит оба, и повторы в отчете показывают,
+отсекает ли их дедупликация.
+
+Запуск:
+    python benchmarks/e2e_benchmark.py --rate 5 --duration 60 --latency 50 --throttle-every 20
+    python benchmarks/e2e_benchmark.py --capture poll --rate 5 --duration 60
+
+Нужен установленный Chrome/chromedriver (браузер запускается без окна).
+"""
+import argparse
+import importlib.util
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+DEFAULT_BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot-MAX_TG(BETA2).py")
+BENCH_TOKEN = "bench:token"
+BENCH_CHAT_ID = "-1001"
+MESSAGE_PATTERN = re.compile(r"#(\d+) @(\d+)")
+
+# Страница группы: сообщения добавляются с частотой rate в секунду, на странице остается keep последних
+FAKE_GROUP_PAGE = """<!doctype html>
+<html>
+<head><meta charset="utf-8"><title>MAX bench</title></head>
+<body>
+<div id="chat" class="chat-history"></div>
+<script>
+const rate = %(rate)s;
+const keep = %(keep)s;
+const chat = document.getElementById('chat');
+const started = performance.now();
+let next = 1;
+const emit = () => {
+    const due = Math.floor((performance.now() - started) / 1000 * rate) + 1;
+    while (next <= due) {
+        const item = document.createElement('div');
+        item.className = 'message';
+        item.setAttribute('data-message-id', String(next));
+        const text = document.createElement('span');
+        text.className = 'message-text';
+        text.textContent = `bench: #${next} @${Date.now()}`;
+        item.appendChild(text);
+        chat.appendChild(item);
+        next++;
+        while (chat.childElementCount > keep) {
+            chat.removeChild(chat.firstElementChild);
+        }
+    }
+};
+setInterval(emit, Math.max(10, Math.min(1000, 1000 / rate)));
+</script>
+</body>
+</html>
+"""
+
+FAKE_LOGIN_PAGE = """<!doctype html>
+<html><head><meta charset="utf-8"><title>MAX bench</title></head><body>login</body></html>
+"""
+
+def load_bot(path):
+    """Загрузка модуля бота по пути (имя файла не является именем модуля)"""
+    spec = importlib.util.spec_from_file_location("bot_under_test", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class FakeMaxHandler(BaseHTTPRequestHandler):
+    """Страница входа (/) и страница группы (/group?rate=...&keep=...)"""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/group":
+            query = parse_qs(url.query)
+            body = FAKE_GROUP_PAGE % {
+                "rate": float(query.get("rate", ["1"])[0]),
+                "keep": int(query.get("keep", ["200"])[0])
+            }
+        else:
+            body = FAKE_LOGIN_PAGE
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    """Заглушка POST /bot<token>/sendMessage с задержкой ответа и отказами 429"""
+
+    def do_POST(self):
+        state = self.server.state
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        if state.latency:
+            time.sleep(state.latency)
+
+        with state.lock:
+            state.requests += 1
+            throttle = state.throttle_every and state.requests % state.throttle_every == 0
+            if throttle:
+                state.throttled += 1
+            else:
+                received_ms = time.time() * 1000
+                for number, inserted_ms in MESSAGE_PATTERN.findall(payload.get("text", "")):
+                    number = int(number)
+                    if number not in state.received:
+                        state.received[number] = (int(inserted_ms), received_ms)
+                    else:
+                        # Повторная доставка — регрессия дедупликации, а не шум замера
+                        state.duplicates[number] = state.duplicates.get(number, 0) + 1
+
+        if throttle:
+            response = {"ok": False, "error_code": 429, "description": "Too Many Requests: retry later",
+                        "parameters": {"retry_after": state.retry_after}}
+            status = 429
+        else:
+            response = {"ok": True, "result": {"message_id": state.requests, "chat": {"id": payload.get("chat_id")}}}
+            status = 200
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeTelegramState:
+    def __init__(self, latency, throttle_every, retry_after):
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.received = {}  # номер сообщения -> (вставлено, получено), мс
+        self.duplicates = {}  # номер сообщения -> сколько раз получено сверх первого
+
+def start_server(handler, state=None):
+    """Запуск HTTP-сервера на свободном локальном порту"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def summarize(bot, state, measure_from_ms, sampler):
+    """Итог замера по сообщениям, вставленным после начала пересылки"""
+    with state.lock:
+        received = {number: times for number, times in state.received.items() if times[0] >= measure_from_ms}
+        requests, throttled = state.requests, state.throttled
+        duplicates = sum(count for number, count in state.duplicates.items() if number in received)
+    report = {"delivered": len(received), "duplicates": duplicates, "requests": requests, "throttled": throttled}
+    if received:
+        latencies = sorted(receipt - inserted for inserted, receipt in received.values())
+        receipts = sorted(receipt for _, receipt in received.values())
+        span = (receipts[-1] - receipts[0]) / 1000
+        numbers = sorted(received)
+        report.update({
+            "latency_ms": {
+                "p50": percentile(latencies, 0.50),
+                "p95": percentile(latencies, 0.95),
+                "p99": percentile(latencies, 0.99),
+                "max": latencies[-1],
+                "mean": statistics.fmean(latencies)
+            },
+            "throughput_per_second": (len(received) - 1) / span if span > 0 else None,
+            "missing": numbers[-1] - numbers[0] + 1 - len(numbers)
+        })
+    resources = sampler.get_stats()["metrics"]
+    report["resources"] = {
+        name: resources[name] for name in ("bot_cpu_percent", "bot_rss_mb", "browser_cpu_percent", "browser_rss_mb")
+        if name in resources
+    }
+    for metric in report["resources"].values():
+        metric.pop("trend", None)
+    report["stages"] = bot.forwarder.stage_stats.get_stats()
+    return report
+
+def run(args):
+    bot_path = os.path.abspath(args.bot)
+    # Состояние бота (настройки, журнал) — во временном каталоге, рабочие файлы не трогаем
+    os.chdir(tempfile.mkdtemp(prefix="max-bench-"))
+    bot = load_bot(bot_path)
+    bot.CAPTURE_MODE = args.capture
+    bot.COALESCE_ENABLED = not args.no_coalesce
+    if args.unlimited:
+        bot.GLOBAL_RATE_PER_SECOND = bot.GROUP_RATE_PER_MINUTE = bot.PRIVATE_RATE_PER_SECOND = 10 ** 6
+
+    max_server, max_url = start_server(FakeMaxHandler)
+    state = FakeTelegramState(args.latency / 1000, args.throttle_every, args.retry_after)
+    telegram_server, telegram_url = start_server(FakeTelegramHandler, state)
+
+    bot.bot_settings.settings["selected_chat_id"] = BENCH_CHAT_ID
+    bot.bot_settings.settings["admin_chat_id"] = None
+    forwarder = bot.MaxToTelegramForwarder(
+        bot.bot_settings,
+        max_url=f"{max_url}/",
+        group_urls=[f"{max_url}/group?rate={args.rate}&keep={args.keep}"],
+        telegram_api_url=telegram_url,
+        telegram_token=BENCH_TOKEN,
+        outbox_path="bench_outbox.jsonl",
+        headless=not args.show_browser
+    )
+    bot.forwarder = forwarder
+    forwarder.is_ready = True  # вход в MAX не нужен
+
+    sampler = bot.MetricsSampler(interval=1)
+    sampler.sample()
+    threading.Thread(target=forwarder.start_forwarding_process, name="forwarder", daemon=True).start()
+
+    # Замер начинается с первого такта: сообщения, вставленные во время запуска браузера, не учитываются
+    started = time.monotonic()
+    while not forwarder.stage_stats.get_stats():
+        if time.monotonic() - started > args.startup_timeout or not forwarder.forwarding_active:
+            print("❌ Пересылка не запустилась (есть ли Chrome/chromedriver?)", file=sys.stderr)
+            return None
+        time.sleep(0.1)
+    measure_from_ms = time.time() * 1000
+
+    deadline = time.monotonic() + args.duration
+    while time.monotonic() < deadline:
+        time.sleep(1)
+        sampler.sample()
+
+    forwarder.stop_forwarding()
+    # Досылаем склеенное и стоящее в очереди
+    time.sleep(args.drain)
+
+    report = summarize(bot, state, measure_from_ms, sampler)
+    report["config"] = {
+        "rate": args.rate, "duration": args.duration, "latency_ms": args.latency,
+        "throttle_every": args.throttle_every, "retry_after": args.retry_after,
+        "capture": args.capture, "coalesce": not args.no_coalesce, "unlimited": args.unlimited,
+        "bot": os.path.basename(bot_path)
+    }
+    max_server.shutdown()
+    telegram_server.shutdown()
+    return report
+
+def print_report(report):
+    print(f"Доставлено: {report['delivered']} (пропущено {report.get('missing', 0)}, "
+          f"повторов {report['duplicates']}), запросов sendMessage: {report['requests']}, из них 429: {report['throttled']}")
+    if report["duplicates"]:
+        print(f"⚠️ Сообщения доставлены повторно (режим {report['config']['capture']}): проверьте дедупликацию")
+    if "latency_ms" in report:
+        latency = report["latency_ms"]
+        print(f"Задержка, мс: p50 {latency['p50']:.0f}, p95 {latency['p95']:.0f}, "
+              f"p99 {latency['p99']:.0f}, макс. {latency['max']:.0f}")
+        if report["throughput_per_second"]:
+            print(f"Скорость: {report['throughput_per_second']:.2f} сообщений/с")
+    for name, metric in report["resources"].items():
+        print(f"{name}: мин {metric['min']:.1f}, сред {metric['avg']:.1f}, макс {metric['max']:.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Сквозной замер пересылки MAX → Telegram на локальных заглушках")
+    parser.add_argument("--bot", default=DEFAULT_BOT_PATH, help="файл бота для замера")
+    parser.add_argument("--rate", type=float, default=2, help="сообщений в секунду на странице")
+    parser.add_argument("--keep", type=int, default=200, help="сколько сообщений остается в DOM")
+    parser.add_argument("--duration", type=float, default=60, help="длительность замера, секунды")
+    parser.add_argument("--latency", type=float, default=50, help="задержка ответа sendMessage, мс")
+    parser.add_argument("--throttle-every", type=int, default=0, help="отвечать 429 на каждый N-й запрос (0 — никогда)")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответе 429, секунды")
+    parser.add_argument("--capture", choices=["observer", "poll"], default="observer", help="способ получения сообщений")
+    parser.add_argument("--no-coalesce", action="store_true", help="отключить склейку сообщений")
+    parser.add_argument("--unlimited", action="store_true", help="снять лимиты скорости Telegram")
+    parser.add_argument("--drain", type=float, default=5, help="сколько ждать досылки после остановки, секунды")
+    parser.add_argument("--startup-timeout", type=float, default=120, help="сколько ждать запуска пересылки, секунды")
+    parser.add_argument("--show-browser", action="store_true", help="запускать браузер с окном")
+    parser.add_argument("--json", help="записать результат в JSON-файл")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    report = run(args)
+    if report is None:
+        sys.exit(1)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""Микрозамеры горячих участков на чистом Python: дедупликация, сохранение истории, хеш, фильтр извлечения.
+
+Замер выполняется над любой ревизией бота (BETA, BETA2 и т. д.): структура
+данных берется у самого модуля, поэтому цифры разных ревизий сравнимы.
+
+Запуск:
+    python benchmarks/micro_benchmark.py --json micro.json
+    python benchmarks/micro_benchmark.py --compare "bot-MAX_TG(BETA).py" "bot-MAX_TG(BETA2).py" --json compare.json
+
+В режиме --compare каждая ревизия замеряется в отдельном процессе, в JSON
+попадают результаты обеих и отношение времени (вторая / первая). Замеры, в которых
+ревизия сама обрезала историю ниже заданного размера, помечаются "comparable": false
+и в отношение не входят.
+"""
+import argparse
+import hashlib
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BOT_PATH = os.path.join(BENCH_DIR, "..", "bot-MAX_TG(BETA2).py")
+DOM_FIXTURE = os.path.join(BENCH_DIR, "fixtures", "dom_texts.json")
+DEDUP_SIZES = [1_000, 100_000, 1_000_000]
+SAVE_SIZES = [1_000, 10_000, 100_000]
+CHAT_ID = "-1001"
+
+def load_bot(path):
+    """Загрузка модуля бота по пути (имя файла не является именем модуля)"""
+    spec = importlib.util.spec_from_file_location("bot_under_test", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def measure(function, repeat=5, min_time=0.2):
+    """Медиана времени одного вызова в наносекундах (подбор числа вызовов как в timeit)"""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    timings = timer.repeat(repeat=repeat, number=number)
+    return {"ns_per_op": statistics.median(timings) / number * 1e9, "ops": number * repeat}
+
+def make_hashes(count, salt=""):
+    return [hashlib.md5(f"{salt}{i}".encode()).hexdigest() for i in range(count)]
+
+def fill_history(bot, settings, hashes):
+    """История одного чата в структуре данных ревизии (окно не меньше числа хешей)"""
+    if hasattr(bot, "MessageHashIndex"):
+        settings.processed_messages[CHAT_ID] = bot.MessageHashIndex(hashes, limit=len(hashes))
+    else:
+        settings.processed_messages[CHAT_ID] = list(hashes)
+
+class FakeElement:
+    def __init__(self, text):
+        self.text = text
+
+class FakeDriver:
+    """Драйвер, возвращающий записанные тексты элементов страницы"""
+
+    def __init__(self, texts):
+        self.elements = [FakeElement(text) for text in texts]
+
+    def find_elements(self, by, selector):
+        return self.elements
+
+def bench_dedup(bot, results):
+    settings = bot.bot_settings
+    for size in DEDUP_SIZES:
+        hashes = make_hashes(size)
+        fill_history(bot, settings, hashes)
+        present = hashes[size // 2]
+        missing = hashlib.md5(b"missing").hexdigest()
+        results[f"is_message_processed.hit[{size}]"] = measure(lambda: settings.is_message_processed(CHAT_ID, present))
+        results[f"is_message_processed.miss[{size}]"] = measure(lambda: settings.is_message_processed(CHAT_ID, missing))
+
+        new_hashes = (f"new-{i:028d}" for i in itertools.count())
+        # Каждый вызов добавляет новый хеш: запись на диск (если ревизия пишет синхронно) входит в замер
+        result = measure(lambda: settings.add_processed_message(CHAT_ID, next(new_hashes)), repeat=3)
+        # Ревизия может сама обрезать историю (BETA оставляет 900 хешей после 1000):
+        # тогда замер шел на меньшей истории и с другими ревизиями при этом размере не сравним
+        result["history_size"] = len(settings.processed_messages[CHAT_ID])
+        result["comparable"] = result["history_size"] >= size
+        results[f"add_processed_message[{size}]"] = result
+        if hasattr(settings, "flush"):
+            # Отложенную запись выполняем вне замера, чтобы она не мешала следующему размеру
+            settings.flush()
+        settings.processed_messages.clear()
+
+def bench_save(bot, results):
+    settings = bot.bot_settings
+    for size in SAVE_SIZES:
+        fill_history(bot, settings, make_hashes(size))
+        if hasattr(settings, "storage"):
+            # Запись истории без отложенного потока: только сериализация и файл
+            save = lambda: settings.storage.save_processed_messages(settings.processed_messages, [])
+        else:
+            save = settings.save_processed_messages
+        results[f"save_processed_messages[{size}]"] = measure(save, repeat=3, min_time=0.05)
+        settings.processed_messages.clear()
+
+def bench_hash(bot, results, texts):
+    forwarder = bot.forwarder
+    text = max(texts, key=len)
+    results["get_message_hash.text"] = measure(lambda: forwarder.get_message_hash(text))
+    if hasattr(bot, "normalize_message"):
+        message = bot.normalize_message({"id": "m-1042", "ts": "2024-03-12T12:41:00", "author": "Павел", "text": text})
+        results["get_message_hash.message"] = measure(lambda: forwarder.get_message_hash(message))
+
+def bench_extraction(bot, results, texts):
+    forwarder = bot.forwarder
+    forwarder.driver = FakeDriver(texts)
+    if hasattr(bot, "EXTRACTION_MODE"):
+        # Фильтр на Python (как в BETA), а не внутри страницы
+        bot.EXTRACTION_MODE = "elements"
+    candidates = forwarder.extract_messages_from_max()
+    results["extract_messages_from_max"] = measure(forwarder.extract_messages_from_max)
+    results["extract_messages_from_max"]["candidates"] = len(candidates)
+    if hasattr(bot, "is_message_candidate"):
+        results["is_message_candidate.all_texts"] = measure(
+            lambda: [text for text in texts if bot.is_message_candidate(text)])
+    forwarder.driver = None
+
+def run_single(bot_path):
+    bot_path = os.path.abspath(bot_path)
+    with open(DOM_FIXTURE, encoding="utf-8") as f:
+        texts = json.load(f)["texts"]
+    # Файлы состояния ревизии создаются во временном каталоге
+    os.chdir(tempfile.mkdtemp(prefix="max-micro-"))
+    bot = load_bot(bot_path)
+    bot.logger.disabled = True
+
+    results = {}
+    started = time.perf_counter()
+    bench_hash(bot, results, texts)
+    bench_extraction(bot, results, texts)
+    bench_dedup(bot, results)
+    bench_save(bot, results)
+    return {
+        "bot": os.path.basename(bot_path),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "duration": time.perf_counter() - started,
+        "results": results
+    }
+
+def run_compare(paths):
+    """Каждая ревизия — в своем процессе (модули бота создают глобальные объекты и потоки)"""
+    runs = []
+    for path in paths:
+        output = subprocess.run([sys.executable, __file__, "--bot", path, "--json", "-"],
+                                check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output))
+    base, other = runs[0]["results"], runs[-1]["results"]
+    ratios = {name: other[name]["ns_per_op"] / base[name]["ns_per_op"]
+              for name in base if name in other and base[name]["ns_per_op"]
+              and base[name].get("comparable", True) and other[name].get("comparable", True)}
+    return {"runs": runs, "ratio": ratios}
+
+def print_single(report):
+    print(f"{report['bot']} (Python {report['python']})")
+    for name, result in report["results"].items():
+        note = "" if result.get("comparable", True) else f" (история обрезана до {result['history_size']})"
+        print(f"  {name:45} {result['ns_per_op'] / 1000:12.2f} мкс{note}")
+
+def print_compare(report):
+    base, other = report["runs"][0], report["runs"][-1]
+    print(f"{'замер':45} {base['bot']:>22} {other['bot']:>22} {'отношение':>10}")
+    for name in list(base["results"]) + [name for name in other["results"] if name not in base["results"]]:
+        result = base["results"].get(name)
+        other_result = other["results"].get(name)
+        other_text = f"{other_result['ns_per_op'] / 1000:.2f} мкс" if other_result else "—"
+        ratio = report["ratio"].get(name)
+        if ratio is not None:
+            ratio_text = f"{ratio:.3f}"
+        elif result and other_result:
+            ratio_text = "несравнимо"
+        else:
+            ratio_text = "—"
+        base_text = f"{result['ns_per_op'] / 1000:.2f} мкс" if result else "—"
+        print(f"{name:45} {base_text:>22} {other_text:>22} {ratio_text:>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Микрозамеры дедупликации, сохранения, хеша и фильтра извлечения")
+    parser.add_argument("--bot", default=DEFAULT_BOT_PATH, help="файл бота для замера")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="сравнить две ревизии бота")
+    parser.add_argument("--json", help="записать результат в JSON-файл ('-' — в stdout)")
+    args = parser.parse_args()
+    json_path = os.path.abspath(args.json) if args.json and args.json != "-" else args.json
+
+    if args.compare:
+        report = run_compare([os.path.abspath(path) for path in args.compare])
+    else:
+        report = run_single(args.bot)
+
+    if json_path == "-":
+        json.dump(report, sys.stdout, ensure_ascii=False)
+        return
+    if args.compare:
+        print_compare(report)
+    else:
+        print_single(report)
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
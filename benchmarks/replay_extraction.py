@@ -0,0 +1,287 @@
+"""Офлайн-сравнение способов извлечения сообщений на записанных снимках страницы MAX.
+
+Снимки пишет сам бот, если задан SNAPSHOT_FILE: HTML страницы группы и найденные
+в такте сообщения, по одному JSON в строке, сжато gzip. Здесь каждый снимок
+загружается в локальный браузер без окна (скрипты страницы вырезаются), и на нем
+запускаются выбранные способы извлечения. Для каждого способа считаются время,
+точность (precision) и полнота (recall) относительно эталона.
+
+Эталон — сообщения, найденные ботом при записи, либо разметка из --labels
+(JSON {"<номер снимка>": ["текст", ...]}). В режиме наблюдателя бот записывает
+только новые сообщения такта, поэтому для оценки полноты лучше разметка.
+
+Запуск:
+    python benchmarks/replay_extraction.py snapshots.jsonl.gz --strategy script --strategy elements
+    python benchmarks/replay_extraction.py snapshots.jsonl.gz --no-browser --json replay.json
+    python benchmarks/replay_extraction.py snapshots.jsonl.gz --strategy my_strategies.py:extract_last_bubbles
+
+Свой способ — функция strategy(context) -> список текстов или словарей {id, ts, author, text};
+context.driver (None без браузера), context.html, context.bot (модуль бота).
+"""
+import argparse
+import gzip
+import importlib.util
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+from html.parser import HTMLParser
+
+DEFAULT_BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot-MAX_TG(BETA2).py")
+SCRIPT_TAG = re.compile(r"<script\b[^>]*>.*?</script\s*>", re.IGNORECASE | re.DOTALL)
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+BLOCK_TAGS = {"div", "p", "li", "ul", "ol", "section", "article", "header", "footer", "br", "tr", "h1", "h2", "h3"}
+ID_ATTRIBUTES = ("data-message-id", "data-msg-id", "data-mid", "data-id")
+
+def load_bot(path):
+    """Загрузка модуля бота по пути (имя файла не является именем модуля)"""
+    spec = importlib.util.spec_from_file_location("bot_under_test", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def load_snapshots(path):
+    """Снимки из файла; оборванный при записи конец файла пропускается"""
+    snapshots = []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                try:
+                    snapshots.append(json.loads(line))
+                except ValueError:
+                    continue
+        except (EOFError, OSError):
+            print("⚠️ Файл снимков оборван, используются прочитанные снимки", file=sys.stderr)
+    return snapshots
+
+class ReplayContext:
+    def __init__(self, bot, driver, html):
+        self.bot = bot
+        self.driver = driver
+        self.html = html
+
+class _Element:
+    def __init__(self, tag, attrs, parent):
+        self.tag = tag
+        self.attrs = dict(attrs)
+        self.parent = parent
+        self.parts = []  # строки и дочерние элементы по порядку
+
+    def text(self):
+        """Приближение innerText: текст потомков, блочные элементы с новой строки"""
+        chunks = []
+        for part in self.parts:
+            if isinstance(part, _Element):
+                chunk = part.text()
+                chunks.append(f"\n{chunk}\n" if part.tag in BLOCK_TAGS else chunk)
+            else:
+                chunks.append(part)
+        text = "".join(chunks)
+        text = re.sub(r"[ \t\r\f\v]+", " ", text)
+        return re.sub(r"\s*\n\s*", "\n", text).strip()
+
+class _TreeBuilder(HTMLParser):
+    """Дерево элементов страницы на html.parser (без браузера)"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.root = _Element("#document", [], None)
+        self.current = self.root
+        self.elements = []
+
+    def handle_starttag(self, tag, attrs):
+        element = _Element(tag, attrs, self.current)
+        self.current.parts.append(element)
+        self.elements.append(element)
+        if tag not in VOID_TAGS:
+            self.current = element
+
+    def handle_startendtag(self, tag, attrs):
+        element = _Element(tag, attrs, self.current)
+        self.current.parts.append(element)
+        self.elements.append(element)
+
+    def handle_endtag(self, tag):
+        node = self.current
+        while node is not self.root and node.tag != tag:
+            node = node.parent
+        if node is not self.root:
+            self.current = node.parent
+
+    def handle_data(self, data):
+        if self.current.tag not in ("style", "script"):
+            self.current.parts.append(data)
+
+def strategy_python_html(context):
+    """Тот же фильтр, что EXTRACT_MESSAGES_SCRIPT, на дереве html.parser (без браузера)"""
+    bot = context.bot
+    builder = _TreeBuilder()
+    builder.feed(context.html)
+    elements = [element for element in builder.elements if "class" in element.attrs]
+    messages = []
+    for element in elements[-bot.EXTRACTION_SCAN_LIMIT:]:
+        text = element.text()
+        if not bot.is_message_candidate(text):
+            continue
+        message_id = ""
+        node = element
+        while node is not None and not message_id:
+            message_id = next((node.attrs[name] for name in ID_ATTRIBUTES if node.attrs.get(name)), "")
+            node = node.parent
+        messages.append({"id": message_id, "text": text})
+    return messages
+
+def strategy_script(context):
+    """Извлечение одним execute_script (EXTRACTION_MODE = "script")"""
+    bot = context.bot
+    return context.driver.execute_script(
+        bot.EXTRACT_MESSAGES_SCRIPT,
+        bot.EXTRACTION_SCAN_LIMIT, bot.MESSAGE_MIN_LENGTH, bot.MESSAGE_MAX_LENGTH, bot.MESSAGE_KEYWORDS
+    )
+
+def strategy_elements(context):
+    """find_elements + element.text для каждого элемента (EXTRACTION_MODE = "elements", как в BETA)"""
+    bot = context.bot
+    elements = context.driver.find_elements(bot.By.CSS_SELECTOR, "[class]")
+    messages = []
+    for element in elements[-bot.EXTRACTION_SCAN_LIMIT:]:
+        try:
+            text = element.text.strip()
+        except Exception:
+            continue
+        if bot.is_message_candidate(text):
+            messages.append(text)
+    return messages
+
+# Встроенные способы: имя -> (функция, нужен ли браузер)
+STRATEGIES = {
+    "script": (strategy_script, True),
+    "elements": (strategy_elements, True),
+    "python-html": (strategy_python_html, False)
+}
+
+def resolve_strategy(name):
+    """Встроенный способ по имени или функция из файла: path.py:function"""
+    if name in STRATEGIES:
+        return STRATEGIES[name]
+    path, _, function_name = name.rpartition(":")
+    if not path:
+        raise SystemExit(f"Неизвестный способ извлечения: {name}")
+    spec = importlib.util.spec_from_file_location("replay_strategy", os.path.abspath(path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    function = getattr(module, function_name)
+    return function, getattr(function, "needs_browser", True)
+
+def start_browser(bot):
+    chrome_options = bot.Options()
+    chrome_options.add_argument("--headless=new")
+    chrome_options.add_argument("--disable-gpu")
+    return bot.webdriver.Chrome(options=chrome_options)
+
+def load_into_browser(driver, html):
+    """HTML снимка в пустую страницу; скрипты MAX вырезаны, чтобы страница не менялась во время замера"""
+    driver.get("about:blank")
+    driver.execute_script("document.open(); document.write(arguments[0]); document.close();", SCRIPT_TAG.sub("", html))
+
+def texts_of(bot, messages):
+    return {bot.normalize_message(message)["text"] for message in messages or []}
+
+def replay(args):
+    snapshots_path = os.path.abspath(args.snapshots)
+    labels = {}
+    if args.labels:
+        with open(args.labels, encoding="utf-8") as f:
+            labels = {int(index): set(texts) for index, texts in json.load(f).items()}
+    bot_path = os.path.abspath(args.bot)
+    os.chdir(tempfile.mkdtemp(prefix="max-replay-"))
+    bot = load_bot(bot_path)
+    bot.logger.disabled = True
+
+    snapshots = load_snapshots(snapshots_path)
+    if args.limit:
+        snapshots = snapshots[:args.limit]
+    names = args.strategy or (["python-html"] if args.no_browser else ["script", "elements", "python-html"])
+    strategies = {name: resolve_strategy(name) for name in names}
+    if args.no_browser:
+        strategies = {name: strategy for name, strategy in strategies.items() if not strategy[1]}
+    driver = start_browser(bot) if any(needs_browser for _, needs_browser in strategies.values()) else None
+
+    stats = {name: {"timings": [], "found": 0, "expected": 0, "matched": 0, "errors": 0} for name in strategies}
+    try:
+        for index, snapshot in enumerate(snapshots):
+            expected = labels.get(index) if labels else texts_of(bot, snapshot.get("candidates"))
+            if expected is None:
+                continue
+            if driver:
+                load_into_browser(driver, snapshot["html"])
+            context = ReplayContext(bot, driver, snapshot["html"])
+            for name, (strategy, _) in strategies.items():
+                started = time.perf_counter()
+                try:
+                    found = texts_of(bot, strategy(context))
+                except Exception as e:
+                    stats[name]["errors"] += 1
+                    print(f"⚠️ {name}, снимок {index}: {e}", file=sys.stderr)
+                    continue
+                stats[name]["timings"].append(time.perf_counter() - started)
+                stats[name]["found"] += len(found)
+                stats[name]["expected"] += len(expected)
+                stats[name]["matched"] += len(found & expected)
+    finally:
+        if driver:
+            driver.quit()
+
+    report = {"snapshots": len(snapshots), "reference": "labels" if labels else "recorded", "strategies": {}}
+    for name, strategy_stats in stats.items():
+        timings = sorted(strategy_stats["timings"])
+        result = {
+            "runs": len(timings),
+            "errors": strategy_stats["errors"],
+            "precision": strategy_stats["matched"] / strategy_stats["found"] if strategy_stats["found"] else None,
+            "recall": strategy_stats["matched"] / strategy_stats["expected"] if strategy_stats["expected"] else None
+        }
+        if timings:
+            result["time_ms"] = {
+                "mean": statistics.fmean(timings) * 1000,
+                "p50": timings[len(timings) // 2] * 1000,
+                "p95": timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000
+            }
+        report["strategies"][name] = result
+    return report
+
+def print_report(report):
+    print(f"Снимков: {report['snapshots']}, эталон: {report['reference']}")
+    for name, result in report["strategies"].items():
+        precision = f"{result['precision']:.3f}" if result["precision"] is not None else "—"
+        recall = f"{result['recall']:.3f}" if result["recall"] is not None else "—"
+        time_text = ""
+        if "time_ms" in result:
+            time_text = f", время p50 {result['time_ms']['p50']:.2f} мс, p95 {result['time_ms']['p95']:.2f} мс"
+        print(f"• {name}: точность {precision}, полнота {recall}{time_text}, ошибок {result['errors']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение способов извлечения сообщений на записанных снимках MAX")
+    parser.add_argument("snapshots", help="файл снимков (SNAPSHOT_FILE бота)")
+    parser.add_argument("--strategy", action="append", help="способ: script, elements, python-html или path.py:function")
+    parser.add_argument("--labels", help="разметка: JSON {номер снимка: [тексты сообщений]}")
+    parser.add_argument("--bot", default=DEFAULT_BOT_PATH, help="файл бота (скрипты и фильтр извлечения)")
+    parser.add_argument("--no-browser", action="store_true", help="только способы без браузера")
+    parser.add_argument("--limit", type=int, help="сколько снимков использовать")
+    parser.add_argument("--json", help="записать результат в JSON-файл")
+    args = parser.parse_args()
+    json_path = os.path.abspath(args.json) if args.json else None
+    if args.labels:
+        args.labels = os.path.abspath(args.labels)
+
+    report = replay(args)
+    print_report(report)
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
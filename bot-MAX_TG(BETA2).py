@@ -1,9 +1,14 @@
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import TimeoutException
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+from telegram.error import BadRequest, ChatMigrated, Forbidden, InvalidToken, RetryAfter, TelegramError
 import requests
+import asyncio
+import functools
 import time
 import logging
 import hashlib
@@ -13,18 +18,145 @@ import threading
 import platform
 import psutil
 import socket
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import sqlite3
+import gzip
+import html
+import queue
+import re
+import shlex
+import random
+import statistics
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 # Настройки
 TELEGRAM_BOT_TOKEN = "" #токен для бота в ТГ
 ADMIN_PASSWORD = "" #пароль для админ панели
 MAX_GROUP_URL = "" #URL для чата в MAX
+MAX_GROUP_URLS = []  # несколько групп MAX (каждая в своей вкладке); пустой список — только MAX_GROUP_URL
+MAX_BASE_URL = "https://web.max.ru"  # страница входа в MAX
+BROWSER_HEADLESS = False  # браузер без окна (для стендов; для входа в MAX нужно окно)
+BROWSER_PROFILE_DIR = ""  # каталог профиля Chrome: сессия MAX переживает перезапуск браузера; пустая строка — временный профиль
+TELEGRAM_API_URL = "https://api.telegram.org"  # адрес Bot API (для запросов без Application)
+SEND_TIMEOUT = 10  # таймаут отправки одного сообщения, секунды
+SEND_POOL_SIZE = 8  # размер пула соединений бота к Bot API
+
+# Очередь исходящих сообщений и лимиты Bot API
+OUTBOUND_QUEUE_SIZE = 1000  # сообщений в очереди всего
+OUTBOUND_PUT_TIMEOUT = 30  # сколько ждать места в заполненной очереди, секунды
+GLOBAL_RATE_PER_SECOND = 30  # общий лимит бота
+GROUP_RATE_PER_MINUTE = 20  # лимит на одну группу
+PRIVATE_RATE_PER_SECOND = 1  # лимит на один личный чат
+SEND_MAX_ATTEMPTS = 5  # попыток при временных ошибках (сеть, 5xx); 429 не считается
+
+# Склейка нескольких новых сообщений MAX в одно сообщение Telegram
+COALESCE_ENABLED = True
+COALESCE_WINDOW_SECONDS = 1.5  # сколько копить сообщения перед отправкой
+TELEGRAM_MESSAGE_LIMIT = 4096  # лимит длины сообщения в единицах UTF-16
+FORWARD_PREFIX = "📨 Из MAX:"
+PREFIX_MAX_LENGTH = 200  # лимит префикса маршрута (после экранирования HTML), единиц UTF-16
+COALESCE_SEPARATOR = "\n\n"
 
 # Файлы для хранения данных
 SETTINGS_FILE = "bot_settings.json"
 CHATS_FILE = "telegram_chats.json"
 PROCESSED_MESSAGES_FILE = "processed_messages.json"
 
+# Хранилище состояния: "json" (три файла выше) или "sqlite" (одна база в режиме WAL)
+STORAGE_BACKEND = "json"
+STATE_DB_FILE = "bot_state.db"
+
+# Журнал исходящих сообщений: запись подтверждается только после ответа ok от Telegram
+OUTBOX_FILE = "outbox.jsonl"
+OUTBOX_COMPACT_THRESHOLD = 500  # подтвержденных записей в журнале до его сжатия
+OUTBOX_RETRY_INTERVAL = 60  # как часто переотправлять неподтвержденные записи, секунды
+
+# Размер окна истории обработанных сообщений для каждого чата
+PROCESSED_MESSAGES_LIMIT = 1000
+
+# Отложенная запись файлов: пауза после последнего изменения и максимальная задержка записи
+SAVE_DEBOUNCE_SECONDS = 1.0
+SAVE_MAX_LATENCY_SECONDS = 5.0
+
+# Извлечение сообщений: "script" (один execute_script на странице) или "elements" (find_elements + element.text)
+EXTRACTION_MODE = "script"
+EXTRACTION_SCAN_LIMIT = 50  # сколько последних элементов страницы проверять
+MESSAGE_MIN_LENGTH = 5
+MESSAGE_MAX_LENGTH = 1000
+MESSAGE_KEYWORDS = [':', 'написал', 'отправлено', 'message']
+
+# Захват новых сообщений: "observer" (MutationObserver на странице) или "poll" (периодический опрос DOM)
+CAPTURE_MODE = "observer"
+
+# Вход в MAX: кроме кнопки "Я вошел", страница проверяется на признаки входа (список чатов, поле ввода)
+LOGIN_AUTO_DETECT = True
+LOGIN_CHECK_INTERVAL = 2  # секунд между проверками страницы
+LOGIN_READY_SELECTORS = [
+    "div[contenteditable='true']",
+    "textarea[placeholder*='сообщени']",
+    "input[placeholder*='сообщени']",
+    "input[placeholder*='message']",
+    "[class*='chatList']",
+    "[class*='chat-list']"
+]
+
+# Готовность страницы группы после перехода и обновления: ожидание по условию вместо паузы
+PAGE_READY_TIMEOUT = 30  # сколько ждать, секунды; по истечении работа продолжается с предупреждением
+PAGE_READY_POLL_INTERVAL = 0.25  # как часто проверять страницу, секунды
+PAGE_READY_SELECTORS = [
+    "input[placeholder*='сообщени']",
+    "input[placeholder*='message']",
+    "div[contenteditable='true']",
+    "[class*='message']",
+    "[class*='chat']"
+]
+BROWSER_RESTART_DELAY = 1  # пауза между закрытием и запуском браузера при восстановлении, секунды
+
+# Запись снимков страницы для офлайн-сравнения способов извлечения (benchmarks/replay_extraction.py)
+SNAPSHOT_FILE = ""  # например "snapshots.jsonl.gz"; пустая строка — не записывать
+SNAPSHOT_EVERY_TICKS = 1  # записывать каждый N-й такт
+SNAPSHOT_MAX_MB = 200  # после этого размера файла запись прекращается
+SNAPSHOT_QUEUE_SIZE = 20  # снимков в очереди на сжатие; при переполнении снимок пропускается
+
+# Адаптивный интервал опроса: минимум сразу после активности, рост до потолка при тишине.
+# В режиме наблюдателя интервал — это время ожидания очереди на странице.
+POLL_MIN_INTERVAL = 1.0
+POLL_MAX_INTERVAL = 30.0
+POLL_MAX_INTERVAL_LIMIT = 300  # верхняя граница потолка, настраиваемого из админ-панели
+POLL_BACKOFF_FACTOR = 2.0
+POLL_JITTER = 0.2  # доля случайного разброса интервала
+POLL_STATS_SIZE = 500  # сколько последних тактов хранить для статистики
+OBSERVER_WAIT_SLICE = 1.0  # ожидание очереди наблюдателя частями, чтобы остановка не ждала всю паузу
+ERROR_RETRY_DELAY = 5  # пауза после ошибки такта, секунды
+
+# Замеры этапов такта пересылки
+TICK_STAGES = ["sleep", "extract", "record", "hash", "dedup", "persist", "send", "refresh"]
+SLOW_TICK_SECONDS = 0  # логировать такты дольше порога с разбивкой по этапам (0 — не логировать)
+
+# Обновление страницы MAX только по реальным признакам деградации
+REFRESH_MAX_JS_HEAP_MB = 500  # занятая куча JS страницы
+REFRESH_MAX_DOM_NODES = 150000  # число узлов DOM
+REFRESH_MAX_AGE_SECONDS = 6 * 3600  # время с последней загрузки страницы
+REFRESH_MAX_EXTRACTION_FAILURES = 3  # ошибок извлечения подряд
+REFRESH_METRICS_INTERVAL = 60  # как часто запрашивать Performance.getMetrics через CDP
+
+# Проверки для панели "Производительность" (выполняются параллельно вне цикла событий)
+PROBE_TIMEOUT = 5  # таймаут одного сетевого запроса, секунды
+PROBE_DEADLINE = 8  # общий срок на все проверки; не успевшие показываются как "нет ответа"
+
+# Фоновый сбор метрик ресурсов (история в кольцевых буферах)
+METRICS_SAMPLE_INTERVAL = 60  # секунд между замерами
+METRICS_HISTORY_SIZE = 24 * 60  # замеров в истории (сутки при интервале в минуту)
+SPARKLINE_WIDTH = 24  # символов в графике тренда
+BROWSER_PROCESS_NAMES = ("chrome", "chromedriver", "chromium")
+
+# Экспорт метрик в формате OpenMetrics (Prometheus) на локальном HTTP
+METRICS_HTTP_HOST = "127.0.0.1"
+METRICS_HTTP_PORT = 9108  # 0 — не запускать
+EVENT_LOOP_LAG_INTERVAL = 1.0  # как часто измерять задержку цикла событий, секунды
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -36,12 +168,412 @@ logger = logging.getLogger(__name__)
 BOT_START_TIME = datetime.now()
 TOTAL_FORWARDED_MESSAGES = 0
 
-class BotSettings:
+def write_json_atomic(path, data, indent=None):
+    """Атомарная запись JSON: временный файл и переименование поверх старого"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def _format_labels(labels):
+    """Метки в формате OpenMetrics: {name="value",...}"""
+    if not labels:
+        return ""
+    escaped = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+class Counter:
+    """Монотонный счетчик (с необязательными метками)"""
+    
+    type_name = "counter"
+    
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, amount=1, **labels):
+        key = tuple((name, labels[name]) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def value(self, **labels):
+        key = tuple((name, labels[name]) for name in self.label_names)
+        with self._lock:
+            return self._values.get(key, 0)
+    
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        if not values and not self.label_names:
+            values = {(): 0}
+        return [(f"{self.name}_total", labels, value) for labels, value in values.items()]
+
+class Gauge:
+    """Текущее значение: задается set() или читается функцией при каждом опросе"""
+    
+    type_name = "gauge"
+    
+    def __init__(self, name, documentation, function=None):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self._value = 0
+    
+    def set(self, value):
+        self._value = value
+    
+    def samples(self):
+        value = self._value
+        if self.function:
+            try:
+                value = self.function()
+            except Exception as e:
+                logger.debug(f"Метрика {self.name} недоступна: {e}")
+                return []
+        return [(self.name, (), value)]
+
+class Histogram:
+    """Распределение значений по корзинам с суммой и числом наблюдений"""
+    
+    type_name = "histogram"
+    
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+    
+    def observe(self, value):
+        # Корзин немного: линейный поиск дешевле bisect с учетом вызова
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+    
+    def samples(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            samples.append((f"{self.name}_bucket", (("le", "+Inf" if bound == float("inf") else f"{bound:g}"),), cumulative))
+        samples.append((f"{self.name}_count", (), cumulative))
+        samples.append((f"{self.name}_sum", (), total))
+        return samples
+
+class MetricsRegistry:
+    """Набор метрик пересылки; рендер в текстовый формат OpenMetrics"""
+    
     def __init__(self):
-        self.settings = self.load_settings()
-        self.telegram_chats = self.load_telegram_chats()
-        self.processed_messages = self.load_processed_messages()
+        self._metrics = []
+    
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def counter(self, name, documentation, label_names=()):
+        return self.register(Counter(name, documentation, label_names))
+    
+    def gauge(self, name, documentation, function=None):
+        return self.register(Gauge(name, documentation, function))
+    
+    def histogram(self, name, documentation, buckets):
+        return self.register(Histogram(name, documentation, buckets))
+    
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            for sample_name, labels, value in metric.samples():
+                lines.append(f"{sample_name}{_format_labels(labels)} {value}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+# Метрики пересылки (счетчики увеличиваются по месту события, опрос ничего не пересчитывает)
+METRICS = MetricsRegistry()
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+EXTRACTION_DURATION = METRICS.histogram(
+    "maxtg_extraction_duration_seconds", "Длительность извлечения сообщений со страницы MAX", LATENCY_BUCKETS)
+CANDIDATES_PER_TICK = METRICS.histogram(
+    "maxtg_candidates_per_tick", "Сообщений после курсора за такт", (0, 1, 2, 5, 10, 20, 50, 100))
+DEDUP_HITS = METRICS.counter("maxtg_dedup_hits", "Сообщений, уже пересланных в чат")
+DEDUP_MISSES = METRICS.counter("maxtg_dedup_misses", "Новых сообщений для чата")
+FORWARDED_MESSAGES = METRICS.counter("maxtg_forwarded_messages", "Сообщений, подтвержденных Telegram")
+SEND_LATENCY = METRICS.histogram(
+    "maxtg_send_latency_seconds", "Время одного запроса sendMessage", LATENCY_BUCKETS)
+SEND_RESPONSES = METRICS.counter("maxtg_send_responses", "Ответы Telegram на sendMessage по кодам", ("code",))
+BROWSER_RESTARTS = METRICS.counter("maxtg_browser_restarts", "Перезапусков браузера после ошибок")
+PAGE_REFRESHES = METRICS.counter("maxtg_page_refreshes", "Обновлений страницы MAX")
+PAGE_READY_DURATION = METRICS.histogram(
+    "maxtg_page_ready_seconds", "Время до готовности страницы группы после перехода или обновления",
+    (0.25, 0.5, 1, 2, 5, 10, 20, 30))
+PAGE_READY_TIMEOUTS = METRICS.counter("maxtg_page_ready_timeouts", "Страница группы не стала готовой за отведенное время")
+EVENT_LOOP_LAG = METRICS.histogram(
+    "maxtg_event_loop_lag_seconds", "Опоздание цикла событий бота", LATENCY_BUCKETS)
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """GET /metrics — текущие значения метрик"""
+    
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = METRICS.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass  # опросы Prometheus не засоряют лог
+
+def start_metrics_server(host=METRICS_HTTP_HOST, port=METRICS_HTTP_PORT):
+    """Запуск HTTP-экспортера метрик в фоновом потоке"""
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    except OSError as e:
+        logger.error(f"Не удалось запустить экспорт метрик на {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return server
+
+class MessageHashIndex:
+    """Окно последних хешей сообщений с O(1) проверкой и вытеснением старых"""
+    
+    def __init__(self, hashes=(), limit=PROCESSED_MESSAGES_LIMIT):
+        self.limit = limit
+        self._hashes = OrderedDict()
+        for message_hash in hashes:
+            self.add(message_hash)
+    
+    def __contains__(self, message_hash):
+        return message_hash in self._hashes
+    
+    def __len__(self):
+        return len(self._hashes)
+    
+    def __iter__(self):
+        return iter(self._hashes)
+    
+    def add(self, message_hash):
+        """Добавление хеша; возвращает False, если он уже был в окне"""
+        if message_hash in self._hashes:
+            return False
+        self._hashes[message_hash] = None
+        # Вытесняем самые старые хеши за пределами окна
+        while len(self._hashes) > self.limit:
+            self._hashes.popitem(last=False)
+        return True
+    
+    def to_list(self):
+        """Хеши в порядке добавления (для сохранения в JSON)"""
+        return list(self._hashes)
+
+# Общие функции для скриптов на странице: фильтр текста (как в is_message_candidate)
+# и описание сообщения по атрибутам DOM MAX (id, время, автор)
+MESSAGE_HELPERS_JS = """
+const isCandidate = (text, minLength, maxLength, keywords) => {
+    if (!text || text.length <= minLength || text.length >= maxLength || text.startsWith('http')) {
+        return false;
+    }
+    const lower = text.toLowerCase();
+    return keywords.some(keyword => lower.includes(keyword)) || text.length > 20;
+};
+const ID_SELECTOR = '[data-message-id],[data-msg-id],[data-mid],[data-id]';
+const BUBBLE_EXTRA_LENGTH = 200;
+const findBubble = (element, text) => {
+    // Идентификатор берется только у пузыря этого сообщения: предок с data-id, внутри которого
+    // нет других элементов с идентификатором и почти нет чужого текста (не контейнер чата)
+    const root = element.closest(ID_SELECTOR);
+    if (!root || root.querySelector(ID_SELECTOR)) {
+        return null;
+    }
+    return (root.innerText || '').length <= text.length + BUBBLE_EXTRA_LENGTH ? root : null;
+};
+const describeMessage = (element, text) => {
+    const bubble = findBubble(element, text);
+    const root = bubble || element;
+    const id = bubble ? (bubble.getAttribute('data-message-id') || bubble.getAttribute('data-msg-id')
+        || bubble.getAttribute('data-mid') || bubble.getAttribute('data-id') || '') : '';
+    const timeNode = root.querySelector('time[datetime]') || root.closest('[data-timestamp],[data-time]');
+    const ts = timeNode ? (timeNode.getAttribute('datetime') || timeNode.getAttribute('data-timestamp')
+        || timeNode.getAttribute('data-time') || '') : '';
+    const authorNode = root.querySelector('[class*="author"],[class*="sender"],[class*="name"]');
+    const author = authorNode && authorNode !== element ? (authorNode.innerText || '').trim() : '';
+    return {id: String(id), ts: String(ts), author: author, text: text};
+};
+"""
+
+# Скрипт извлечения: фильтрация и описание сообщений выполняются внутри страницы
+EXTRACT_MESSAGES_SCRIPT = MESSAGE_HELPERS_JS + """
+const [limit, minLength, maxLength, keywords] = arguments;
+const nodes = document.querySelectorAll('[class]');
+const messages = [];
+for (let i = Math.max(0, nodes.length - limit); i < nodes.length; i++) {
+    const text = (nodes[i].innerText || '').trim();
+    if (isCandidate(text, minLength, maxLength, keywords)) {
+        messages.push(describeMessage(nodes[i], text));
+    }
+}
+return messages;
+"""
+
+# Установка MutationObserver: новые узлы с подходящим текстом складываются в очередь на странице
+INSTALL_OBSERVER_SCRIPT = MESSAGE_HELPERS_JS + """
+const [minLength, maxLength, keywords] = arguments;
+if (window.__maxForwarder) {
+    return false;
+}
+const state = {queue: [], waiters: []};
+state.observer = new MutationObserver((records) => {
+    for (const record of records) {
+        for (const node of record.addedNodes) {
+            const element = node.nodeType === Node.ELEMENT_NODE ? node : node.parentElement;
+            if (!element) {
+                continue;
+            }
+            const text = (element.innerText || '').trim();
+            if (isCandidate(text, minLength, maxLength, keywords)) {
+                state.queue.push(describeMessage(element, text));
+            }
+        }
+    }
+    if (state.queue.length) {
+        state.waiters.splice(0).forEach(wake => wake());
+    }
+});
+state.observer.observe(document.body, {childList: true, subtree: true});
+window.__maxForwarder = state;
+return true;
+"""
+
+# Признаки входа одной проверкой на странице: форма телефона — вход не выполнен
+LOGIN_CHECK_SCRIPT = """
+if (document.querySelector("input[type='tel']")) {
+    return false;
+}
+return document.querySelector(arguments[0]) !== null;
+"""
+
+# Готовность страницы одной проверкой: документ загружен и отрисован хотя бы один признак чата
+PAGE_READY_SCRIPT = """
+return document.readyState === "complete" && document.querySelector(arguments[0]) !== null;
+"""
+
+# Выборка очереди наблюдателя: ждет до timeout мс, null — наблюдатель не установлен (страница перезагружена)
+DRAIN_OBSERVER_SCRIPT = """
+const timeoutMs = arguments[0];
+const done = arguments[arguments.length - 1];
+const state = window.__maxForwarder;
+if (!state) {
+    done(null);
+    return;
+}
+if (state.queue.length) {
+    done(state.queue.splice(0));
+    return;
+}
+const finish = () => {
+    clearTimeout(timer);
+    state.waiters = state.waiters.filter(wake => wake !== finish);
+    done(state.queue.splice(0));
+};
+const timer = setTimeout(finish, timeoutMs);
+state.waiters.push(finish);
+"""
+
+def normalize_chat_id(chat_id):
+    """Единый вид ключа чата: после перезагрузки JSON ключи всегда строки"""
+    return str(chat_id)
+
+def normalize_message(message):
+    """Приведение сообщения к словарю {id, ts, author, text}"""
+    if isinstance(message, dict):
+        return {
+            "id": str(message.get("id") or ""),
+            "ts": str(message.get("ts") or ""),
+            "author": str(message.get("author") or ""),
+            "text": str(message.get("text") or "")
+        }
+    return {"id": "", "ts": "", "author": "", "text": str(message)}
+
+def is_identified(message):
+    """Есть ли у сообщения id или время из DOM (только такие сообщения задают курсор)"""
+    return bool(message["id"] or message["ts"])
+
+def _compare_timestamps(left, right):
+    """Сравнение отметок времени MAX: числовых (epoch) или строковых (ISO)"""
+    try:
+        left, right = float(left), float(right)
+    except ValueError:
+        pass
+    return (left > right) - (left < right)
+
+def utf16_length(text):
+    """Длина текста так, как ее считает Telegram (в единицах UTF-16)"""
+    return len(text.encode("utf-16-le")) // 2
+
+def truncate_utf16(text, limit, suffix="..."):
+    """Обрезка текста до limit единиц UTF-16 (с учетом suffix), не разрывая суррогатные пары"""
+    if utf16_length(text) <= limit:
+        return text
+    budget = max(0, limit - utf16_length(suffix))
+    return text.encode("utf-16-le")[:budget * 2].decode("utf-16-le", errors="ignore") + suffix
+
+def escape_html_truncated(text, limit):
+    """Экранирование текста для parse_mode=HTML с обрезкой так, чтобы результат уложился в limit.
+    
+    Обрезается исходный текст, поэтому сущность (&amp; и т. п.) не разрывается.
+    """
+    if limit <= 0:
+        return ""
+    # Многоточие не помещается в лимит: обрезаем без него
+    suffix = "..." if limit > utf16_length("...") else ""
+    raw_limit = limit
+    while True:
+        escaped = html.escape(truncate_utf16(text, raw_limit, suffix), quote=False)
+        escaped_length = utf16_length(escaped)
+        if escaped_length <= limit:
+            return escaped
+        # Сжимаем пропорционально раздуванию при экранировании (не меньше чем на единицу)
+        raw_limit = min(raw_limit - 1, raw_limit * limit // escaped_length)
+
+def is_message_candidate(text):
+    """Фильтр текста элемента: похож ли он на сообщение"""
+    if (text and
+        len(text) > MESSAGE_MIN_LENGTH and
+        len(text) < MESSAGE_MAX_LENGTH and
+        not text.startswith("http")):
         
+        if any(keyword in text.lower() for keyword in MESSAGE_KEYWORDS):
+            return True
+        elif len(text) > 20:
+            return True
+    return False
+
+class JsonStateStorage:
+    """Хранение состояния в трех JSON-файлах (каждая запись переписывает файл целиком)"""
+    
     def load_settings(self):
         """Загрузка настроек из файла"""
         try:
@@ -50,13 +582,7 @@ class BotSettings:
                     return json.load(f)
         except Exception as e:
             logger.error(f"Ошибка загрузки настроек: {e}")
-        return {
-            "forwarding_enabled": False,
-            "admin_chat_id": None,  # ID постоянного администратора
-            "selected_chat_id": None,
-            "auto_start": False,
-            "last_error": None
-        }
+        return None
     
     def load_telegram_chats(self):
         """Загрузка списка чатов из файла"""
@@ -68,65 +594,1440 @@ class BotSettings:
             logger.error(f"Ошибка загрузки чатов: {e}")
         return {}
     
-    def load_processed_messages(self):
-        """Загрузка обработанных сообщений из файла"""
+    def load_processed_messages(self, limit=PROCESSED_MESSAGES_LIMIT):
+        """Загрузка обработанных сообщений из файла: {chat_id: [хеши по порядку]}"""
         try:
             if os.path.exists(PROCESSED_MESSAGES_FILE):
                 with open(PROCESSED_MESSAGES_FILE, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                    data = json.load(f)
+                return {chat_id: hashes[-limit:] for chat_id, hashes in data.items()}
         except Exception as e:
             logger.error(f"Ошибка загрузки обработанных сообщений: {e}")
         return {}
     
+    def save_settings(self, settings):
+        write_json_atomic(SETTINGS_FILE, settings, indent=2)
+    
+    def save_telegram_chats(self, chats):
+        write_json_atomic(CHATS_FILE, chats, indent=2)
+    
+    def save_processed_messages(self, processed_messages, new_entries):
+        data = {chat_id: index.to_list() for chat_id, index in list(processed_messages.items())}
+        write_json_atomic(PROCESSED_MESSAGES_FILE, data)
+    
+    def close(self):
+        pass
+
+class SqliteStateStorage:
+    """Хранение состояния в SQLite (WAL): все изменения пишутся построчными upsert'ами"""
+    
+    def __init__(self, path=STATE_DB_FILE, limit=PROCESSED_MESSAGES_LIMIT):
+        self.path = path
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                CREATE TABLE IF NOT EXISTS telegram_chats (
+                    chat_id TEXT PRIMARY KEY,
+                    title TEXT
+                );
+                CREATE TABLE IF NOT EXISTS processed_messages (
+                    chat_id TEXT NOT NULL,
+                    hash TEXT NOT NULL,
+                    seen_at REAL NOT NULL,
+                    PRIMARY KEY (chat_id, hash)
+                );
+                CREATE INDEX IF NOT EXISTS idx_processed_chat_seen
+                    ON processed_messages (chat_id, seen_at);
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+            """)
+        # Последнее записанное состояние: по нему вычисляем изменившиеся строки
+        self._saved_settings = {}
+        self._saved_chats = {}
+        self.import_json_files()
+    
+    def import_json_files(self):
+        """Однократный перенос данных из JSON-файлов в базу"""
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone():
+                return
+        
+        json_storage = JsonStateStorage()
+        settings = json_storage.load_settings() or {}
+        chats = json_storage.load_telegram_chats()
+        processed = json_storage.load_processed_messages(self.limit)
+        
+        base_time = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value, ensure_ascii=False)) for key, value in settings.items()]
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO telegram_chats (chat_id, title) VALUES (?, ?)",
+                [(str(chat_id), title) for chat_id, title in chats.items()]
+            )
+            for chat_id, hashes in processed.items():
+                # Сохраняем исходный порядок хешей через возрастающее seen_at
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO processed_messages (chat_id, hash, seen_at) VALUES (?, ?, ?)",
+                    [(str(chat_id), message_hash, base_time - (len(hashes) - i) * 1e-3)
+                     for i, message_hash in enumerate(hashes)]
+                )
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_imported', ?)",
+                               (datetime.now().isoformat(),))
+        
+        if settings or chats or processed:
+            logger.info(f"Данные из JSON перенесены в {self.path}")
+    
+    def load_settings(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT key, value FROM settings").fetchall()
+        if not rows:
+            return None
+        settings = {key: json.loads(value) for key, value in rows}
+        self._saved_settings = json.loads(json.dumps(settings))
+        return settings
+    
+    def load_telegram_chats(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT chat_id, title FROM telegram_chats").fetchall()
+        chats = dict(rows)
+        self._saved_chats = dict(chats)
+        return chats
+    
+    def load_processed_messages(self, limit=PROCESSED_MESSAGES_LIMIT):
+        """Загрузка только последних limit хешей каждого чата"""
+        result = {}
+        with self._lock:
+            chat_ids = [row[0] for row in self._conn.execute("SELECT DISTINCT chat_id FROM processed_messages")]
+            for chat_id in chat_ids:
+                rows = self._conn.execute(
+                    "SELECT hash FROM processed_messages WHERE chat_id = ? ORDER BY seen_at DESC LIMIT ?",
+                    (chat_id, limit)
+                ).fetchall()
+                result[chat_id] = [row[0] for row in reversed(rows)]
+        return result
+    
+    def save_settings(self, settings):
+        """Запись только изменившихся ключей настроек"""
+        snapshot = json.loads(json.dumps(settings))
+        changed = [(key, json.dumps(value, ensure_ascii=False)) for key, value in snapshot.items()
+                   if key not in self._saved_settings or self._saved_settings[key] != value]
+        removed = [(key,) for key in self._saved_settings if key not in snapshot]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", changed)
+            self._conn.executemany("DELETE FROM settings WHERE key = ?", removed)
+        self._saved_settings = snapshot
+    
+    def save_telegram_chats(self, chats):
+        """Запись только добавленных, измененных и удаленных чатов"""
+        snapshot = {str(chat_id): title for chat_id, title in chats.items()}
+        changed = [(chat_id, title) for chat_id, title in snapshot.items()
+                   if self._saved_chats.get(chat_id) != title]
+        removed = [(chat_id,) for chat_id in self._saved_chats if chat_id not in snapshot]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO telegram_chats (chat_id, title) VALUES (?, ?)", changed)
+            self._conn.executemany("DELETE FROM telegram_chats WHERE chat_id = ?", removed)
+        self._saved_chats = snapshot
+    
+    def save_processed_messages(self, processed_messages, new_entries):
+        """Вставка новых хешей и обрезка истории чатов до окна limit"""
+        if not new_entries:
+            return
+        chat_ids = {str(chat_id) for chat_id, _, _ in new_entries}
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO processed_messages (chat_id, hash, seen_at) VALUES (?, ?, ?)",
+                [(str(chat_id), message_hash, seen_at) for chat_id, message_hash, seen_at in new_entries]
+            )
+            for chat_id in chat_ids:
+                self._conn.execute(
+                    "DELETE FROM processed_messages WHERE chat_id = ? AND seen_at < ("
+                    "SELECT seen_at FROM processed_messages WHERE chat_id = ? "
+                    "ORDER BY seen_at DESC LIMIT 1 OFFSET ?)",
+                    (chat_id, chat_id, self.limit - 1)
+                )
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def create_state_storage():
+    """Создание хранилища состояния согласно STORAGE_BACKEND"""
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStateStorage(STATE_DB_FILE)
+    return JsonStateStorage()
+
+class BotSettings:
+    def __init__(self, storage=None):
+        self.storage = storage or create_state_storage()
+        self.settings = self.load_settings()
+        self.telegram_chats = self.load_telegram_chats()
+        self.processed_messages = self.load_processed_messages()
+        # Счетчик вместо суммы размеров окон при каждом запросе статистики
+        self.processed_total = sum(len(index) for index in self.processed_messages.values())
+        
+        # Отложенная запись: save_* только помечают данные, запись делает фоновый поток
+        self._dirty = set()
+        self._dirty_since = None
+        self._last_change = None
+        self._new_hashes = []
+        self._route_matcher = None
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        threading.Thread(target=self._flush_loop, name="settings-flusher", daemon=True).start()
+        
+    def load_settings(self):
+        """Загрузка настроек из хранилища"""
+        settings = self.storage.load_settings()
+        if settings is not None:
+            return settings
+        return {
+            "forwarding_enabled": False,
+            "admin_chat_id": None,  # ID постоянного администратора
+            "selected_chat_id": None,
+            "auto_start": False,
+            "last_error": None
+        }
+    
+    def load_telegram_chats(self):
+        """Загрузка списка чатов из хранилища"""
+        return self.storage.load_telegram_chats()
+    
+    def load_processed_messages(self):
+        """Загрузка обработанных сообщений из хранилища"""
+        data = self.storage.load_processed_messages(PROCESSED_MESSAGES_LIMIT)
+        return {normalize_chat_id(chat_id): MessageHashIndex(hashes) for chat_id, hashes in data.items()}
+    
     def save_settings(self):
-        """Сохранение настроек в файл"""
-        try:
-            with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.settings, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"Ошибка сохранения настроек: {e}")
+        """Пометка настроек для отложенной записи в файл"""
+        self._mark_dirty("settings")
     
     def save_telegram_chats(self):
-        """Сохранение списка чатов в файл"""
-        try:
-            with open(CHATS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.telegram_chats, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"Ошибка сохранения чатов: {e}")
+        """Пометка списка чатов для отложенной записи в файл"""
+        self._mark_dirty("chats")
     
     def save_processed_messages(self):
-        """Сохранение обработанных сообщений в файл"""
-        try:
-            with open(PROCESSED_MESSAGES_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.processed_messages, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"Ошибка сохранения обработанных сообщений: {e}")
+        """Пометка обработанных сообщений для отложенной записи в файл"""
+        self._mark_dirty("processed")
+    
+    def _mark_dirty(self, name):
+        """Пометка данных как измененных и пробуждение фонового потока записи"""
+        with self._condition:
+            now = time.monotonic()
+            if not self._dirty:
+                self._dirty_since = now
+            self._dirty.add(name)
+            self._last_change = now
+            self._condition.notify()
+    
+    def _flush_loop(self):
+        """Фоновая запись: ждем паузы в изменениях, но не дольше SAVE_MAX_LATENCY_SECONDS"""
+        while True:
+            with self._condition:
+                while not self._dirty:
+                    self._condition.wait()
+                while self._dirty:
+                    deadline = min(self._last_change + SAVE_DEBOUNCE_SECONDS,
+                                   self._dirty_since + SAVE_MAX_LATENCY_SECONDS)
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+            self.flush()
+    
+    def flush(self):
+        """Немедленная запись всех измененных данных на диск"""
+        with self._flush_lock:
+            with self._condition:
+                dirty = self._dirty
+                self._dirty = set()
+            
+            if "settings" in dirty:
+                try:
+                    self.storage.save_settings(dict(self.settings))
+                except Exception as e:
+                    logger.error(f"Ошибка сохранения настроек: {e}")
+                    self._mark_dirty("settings")
+            
+            if "chats" in dirty:
+                try:
+                    self.storage.save_telegram_chats(dict(self.telegram_chats))
+                except Exception as e:
+                    logger.error(f"Ошибка сохранения чатов: {e}")
+                    self._mark_dirty("chats")
+            
+            if "processed" in dirty:
+                with self._condition:
+                    new_hashes = self._new_hashes
+                    self._new_hashes = []
+                try:
+                    self.storage.save_processed_messages(self.processed_messages, new_hashes)
+                except Exception as e:
+                    logger.error(f"Ошибка сохранения обработанных сообщений: {e}")
+                    with self._condition:
+                        self._new_hashes = new_hashes + self._new_hashes
+                    self._mark_dirty("processed")
+    
+    def close(self):
+        """Запись отложенных изменений и закрытие хранилища"""
+        self.flush()
+        self.storage.close()
     
     def add_processed_message(self, chat_id, message_hash):
         """Добавление обработанного сообщения для конкретного чата"""
+        chat_id = normalize_chat_id(chat_id)
         if chat_id not in self.processed_messages:
-            self.processed_messages[chat_id] = []
+            self.processed_messages[chat_id] = MessageHashIndex()
         
-        # Ограничиваем историю последними 1000 сообщениями для каждого чата
-        if len(self.processed_messages[chat_id]) > 1000:
-            self.processed_messages[chat_id] = self.processed_messages[chat_id][-900:]
-        
-        if message_hash not in self.processed_messages[chat_id]:
-            self.processed_messages[chat_id].append(message_hash)
+        # Окно ограничено PROCESSED_MESSAGES_LIMIT, старые хеши вытесняются автоматически
+        if self.processed_messages[chat_id].add(message_hash):
+            self.processed_total += 1
+            with self._condition:
+                self._new_hashes.append((chat_id, message_hash, time.time()))
             self.save_processed_messages()
     
     def is_message_processed(self, chat_id, message_hash):
         """Проверка, было ли сообщение уже обработано для чата"""
+        chat_id = normalize_chat_id(chat_id)
         return chat_id in self.processed_messages and message_hash in self.processed_messages[chat_id]
+    
+    def get_target_chats(self):
+        """Список чатов Telegram, в которые идет пересылка"""
+        targets = self.settings.get("target_chat_ids")
+        if targets is None:
+            # Старые настройки: единственный выбранный чат
+            selected_chat = self.settings.get("selected_chat_id")
+            targets = [selected_chat] if selected_chat else []
+        return [normalize_chat_id(chat_id) for chat_id in targets]
+    
+    def toggle_target_chat(self, chat_id):
+        """Включение/выключение чата в списке получателей; возвращает новое состояние"""
+        chat_id = normalize_chat_id(chat_id)
+        targets = self.get_target_chats()
+        if chat_id in targets:
+            targets.remove(chat_id)
+            enabled = False
+        else:
+            targets.append(chat_id)
+            enabled = True
+        self.settings["target_chat_ids"] = targets
+        # selected_chat_id остается основным чатом (первым в списке) для совместимости
+        self.settings["selected_chat_id"] = targets[0] if targets else None
+        self.save_settings()
+        return enabled
+    
+    def get_group_targets(self, group):
+        """Чаты-получатели для группы MAX: собственные из group_targets или общий список"""
+        group_targets = self.settings.get("group_targets", {}).get(group)
+        if group_targets:
+            return [normalize_chat_id(chat_id) for chat_id in group_targets]
+        return self.get_target_chats()
+    
+    def get_routes(self):
+        """Таблица маршрутов: [{source, targets, authors, keywords, prefix}]"""
+        return self.settings.get("routes", [])
+    
+    def set_routes(self, routes):
+        """Сохранение маршрутов; пересылка подхватит их со следующего такта"""
+        self.settings["routes"] = routes
+        self._route_matcher = None
+        self.save_settings()
+    
+    def get_route_matcher(self):
+        """Скомпилированные маршруты (компиляция один раз после изменения)"""
+        if self._route_matcher is None:
+            self._route_matcher = RouteMatcher(self.get_routes())
+        return self._route_matcher
+    
+    def get_cursor(self, group):
+        """Курсор последнего пересланного сообщения группы MAX"""
+        return self.settings.get("cursors", {}).get(group)
+    
+    def set_cursor(self, group, cursor):
+        """Сохранение курсора группы MAX (запись только при изменении)"""
+        cursors = self.settings.setdefault("cursors", {})
+        if cursors.get(group) != cursor:
+            cursors[group] = cursor
+            self.save_settings()
+
+class AdaptivePollScheduler:
+    """Адаптивный интервал опроса с экспоненциальным ростом при отсутствии новых сообщений"""
+    
+    def __init__(self, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL,
+                 backoff_factor=POLL_BACKOFF_FACTOR, jitter=POLL_JITTER):
+        self.backoff_factor = backoff_factor
+        self.jitter = jitter
+        self.configure(min_interval, max_interval)
+        self.interval = self.min_interval
+        self.idle_ticks = 0
+        # История тактов: (время, длительность такта, выбранная пауза, новых сообщений)
+        self.ticks = deque(maxlen=POLL_STATS_SIZE)
+    
+    def configure(self, min_interval, max_interval):
+        """Обновление границ интервала (например, после изменения в админ-панели)"""
+        self.min_interval = max(0.1, float(min_interval))
+        self.max_interval = min(POLL_MAX_INTERVAL_LIMIT, max(self.min_interval, float(max_interval)))
+    
+    def record_tick(self, duration, new_messages):
+        """Учет такта: активность сбрасывает интервал к минимуму, тишина увеличивает его"""
+        if new_messages:
+            self.interval = self.min_interval
+            self.idle_ticks = 0
+        else:
+            self.interval = min(self.interval * self.backoff_factor, self.max_interval)
+            self.idle_ticks += 1
+        self.interval = max(self.interval, self.min_interval)
+        delay = self.next_delay()
+        self.ticks.append((time.time(), duration, delay, new_messages))
+        return delay
+    
+    def next_delay(self):
+        """Пауза до следующего такта со случайным разбросом вокруг текущего интервала"""
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+    
+    def get_stats(self):
+        """Статистика последних тактов для панели производительности"""
+        stats = {
+            "interval": self.interval,
+            "min_interval": self.min_interval,
+            "max_interval": self.max_interval,
+            "idle_ticks": self.idle_ticks,
+            "ticks": len(self.ticks)
+        }
+        if self.ticks:
+            durations = sorted(tick[1] for tick in self.ticks)
+            stats["tick_median"] = statistics.median(durations)
+            stats["tick_p95"] = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+            stats["delay_median"] = statistics.median(tick[2] for tick in self.ticks)
+            stats["active_ticks"] = sum(1 for tick in self.ticks if tick[3])
+        return stats
+
+class TickTimer:
+    """Накопление времени этапов одного такта (perf_counter, без блокировок)"""
+    
+    def __init__(self):
+        self.stages = dict.fromkeys(TICK_STAGES, 0.0)
+        self._stage = None
+        self._stage_started = 0.0
+    
+    def start(self, stage):
+        """Начало этапа (предыдущий этап, если был, завершается)"""
+        now = time.perf_counter()
+        if self._stage:
+            self.stages[self._stage] += now - self._stage_started
+        self._stage = stage
+        self._stage_started = now
+    
+    def stop(self):
+        self.start(None)
+    
+    def add(self, stage, seconds):
+        self.stages[stage] += seconds
+    
+    @property
+    def work_time(self):
+        """Время такта без ожидания"""
+        return sum(seconds for stage, seconds in self.stages.items() if stage != "sleep")
+    
+    def format(self):
+        return ", ".join(f"{stage} {seconds * 1000:.1f} мс" for stage, seconds in self.stages.items() if seconds)
+
+class StageStats:
+    """Скользящие перцентили длительности этапов такта"""
+    
+    def __init__(self, size=POLL_STATS_SIZE):
+        self._samples = {stage: deque(maxlen=size) for stage in TICK_STAGES + ["tick"]}
+        self._lock = threading.Lock()
+        self.slow_ticks = 0
+    
+    def record(self, timer):
+        with self._lock:
+            for stage, seconds in timer.stages.items():
+                self._samples[stage].append(seconds)
+            self._samples["tick"].append(timer.work_time)
+    
+    def get_stats(self):
+        """{этап: {p50, p95, p99, count}} в секундах"""
+        with self._lock:
+            samples = {stage: sorted(values) for stage, values in self._samples.items()}
+        stats = {}
+        for stage, values in samples.items():
+            if values:
+                stats[stage] = {
+                    "p50": values[min(len(values) - 1, int(len(values) * 0.50))],
+                    "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+                    "p99": values[min(len(values) - 1, int(len(values) * 0.99))],
+                    "count": len(values)
+                }
+        return stats
+
+class PageRefreshPolicy:
+    """Решение об обновлении страницы по памяти, размеру DOM, возрасту и ошибкам извлечения"""
+    
+    def __init__(self, max_heap_mb=REFRESH_MAX_JS_HEAP_MB, max_dom_nodes=REFRESH_MAX_DOM_NODES,
+                 max_age=REFRESH_MAX_AGE_SECONDS, max_failures=REFRESH_MAX_EXTRACTION_FAILURES,
+                 metrics_interval=REFRESH_METRICS_INTERVAL):
+        self.max_heap_mb = max_heap_mb
+        self.max_dom_nodes = max_dom_nodes
+        self.max_age = max_age
+        self.max_failures = max_failures
+        self.metrics_interval = metrics_interval
+        self.refresh_count = 0
+        self.last_reason = None
+        self.last_metrics = {}
+        self._metrics_session = None
+        self.reset()
+    
+    def reset(self):
+        """Сброс после загрузки страницы (refresh, переход в группу, перезапуск браузера)"""
+        self.loaded_at = time.monotonic()
+        self.failures = 0
+        self._metrics_checked_at = 0
+    
+    def record_extraction(self, success):
+        """Учет результата извлечения сообщений"""
+        self.failures = 0 if success else self.failures + 1
+    
+    def record_refresh(self, reason):
+        self.refresh_count += 1
+        self.last_reason = reason
+        self.reset()
+    
+    def read_page_metrics(self, driver):
+        """Размер кучи JS и число узлов DOM через CDP Performance.getMetrics"""
+        if self._metrics_session != driver.session_id:
+            driver.execute_cdp_cmd("Performance.enable", {})
+            self._metrics_session = driver.session_id
+        result = driver.execute_cdp_cmd("Performance.getMetrics", {})
+        metrics = {item["name"]: item["value"] for item in result.get("metrics", [])}
+        self.last_metrics = {
+            "js_heap_mb": metrics.get("JSHeapUsedSize", 0) / (1024 ** 2),
+            "dom_nodes": int(metrics.get("Nodes", 0))
+        }
+        return self.last_metrics
+    
+    def should_refresh(self, driver):
+        """Причина для обновления страницы или None"""
+        if self.failures >= self.max_failures:
+            return f"ошибок извлечения подряд: {self.failures}"
+        
+        if time.monotonic() - self.loaded_at >= self.max_age:
+            return "страница открыта слишком долго"
+        
+        if time.monotonic() - self._metrics_checked_at >= self.metrics_interval:
+            self._metrics_checked_at = time.monotonic()
+            try:
+                metrics = self.read_page_metrics(driver)
+            except Exception as e:
+                logger.warning(f"Не удалось получить метрики страницы: {e}")
+                return None
+            if metrics["js_heap_mb"] >= self.max_heap_mb:
+                return f"куча JS {metrics['js_heap_mb']:.0f} МБ"
+            if metrics["dom_nodes"] >= self.max_dom_nodes:
+                return f"узлов DOM: {metrics['dom_nodes']}"
+        return None
+    
+    def get_stats(self):
+        return {
+            "refresh_count": self.refresh_count,
+            "last_reason": self.last_reason,
+            "page_age": time.monotonic() - self.loaded_at,
+            **self.last_metrics
+        }
+
+class SendResult:
+    """Результат отправки в Telegram; в логическом контексте истинен при успехе"""
+    
+    def __init__(self, ok, message_id=None, error_code=None, description=None, retry_after=None):
+        self.ok = ok
+        self.message_id = message_id
+        self.error_code = error_code
+        self.description = description
+        self.retry_after = retry_after
+    
+    def __bool__(self):
+        return self.ok
+    
+    def __repr__(self):
+        if self.ok:
+            return f"SendResult(ok, message_id={self.message_id})"
+        return f"SendResult(error_code={self.error_code}, description={self.description!r}, retry_after={self.retry_after})"
+
+class TelegramSender:
+    """Отправка через бота Application (общий пул соединений PTB) или через keep-alive сессию requests"""
+    
+    def __init__(self, token=TELEGRAM_BOT_TOKEN, api_url=TELEGRAM_API_URL, timeout=SEND_TIMEOUT):
+        self.token = token
+        self.api_url = api_url.rstrip("/")
+        self.timeout = timeout
+        self.bot = None
+        self.loop = None
+        self._session = requests.Session()
+        self._session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+        self._session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+        self._executor = ThreadPoolExecutor(max_workers=SEND_POOL_SIZE, thread_name_prefix="telegram-send")
+    
+    def attach(self, bot, loop):
+        """Подключение бота Application и его event loop (вызывается из post_init)"""
+        self.bot = bot
+        self.loop = loop
+    
+    def _loop_available(self):
+        return self.bot is not None and self.loop is not None and not self.loop.is_closed()
+    
+    async def send_async(self, chat_id, text, parse_mode="HTML"):
+        """Отправка из асинхронного кода"""
+        if not self._loop_available():
+            return await asyncio.to_thread(self._send_http, chat_id, text, parse_mode)
+        try:
+            message = await self.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+            return SendResult(True, message_id=message.message_id)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if hasattr(retry_after, "total_seconds"):
+                retry_after = retry_after.total_seconds()
+            return SendResult(False, error_code=429, description=e.message, retry_after=retry_after)
+        except Forbidden as e:
+            return SendResult(False, error_code=403, description=e.message)
+        except InvalidToken as e:
+            return SendResult(False, error_code=401, description=e.message)
+        except ChatMigrated as e:
+            return SendResult(False, error_code=400, description=f"{e.message} (new_chat_id={e.new_chat_id})")
+        except BadRequest as e:
+            return SendResult(False, error_code=400, description=e.message)
+        except TelegramError as e:
+            return SendResult(False, description=e.message)
+        except Exception as e:
+            return SendResult(False, description=str(e))
+    
+    def send(self, chat_id, text, parse_mode="HTML"):
+        """Блокирующая отправка из рабочего потока (через event loop Application)"""
+        if not self._loop_available():
+            return self._send_http(chat_id, text, parse_mode)
+        
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self.loop:
+            # Ждать результат внутри самого event loop нельзя: отправляем в фоне
+            self.loop.create_task(self.send_async(chat_id, text, parse_mode))
+            return SendResult(False, description="отправка запланирована в фоне, результат неизвестен")
+        
+        try:
+            future = asyncio.run_coroutine_threadsafe(self.send_async(chat_id, text, parse_mode), self.loop)
+            return future.result(self.timeout * 3)
+        except Exception as e:
+            return SendResult(False, description=str(e))
+    
+    def submit(self, chat_id, text, parse_mode="HTML"):
+        """Неблокирующая отправка: Future с SendResult (для параллельной доставки в разные чаты)"""
+        if self._loop_available():
+            try:
+                return asyncio.run_coroutine_threadsafe(self.send_async(chat_id, text, parse_mode), self.loop)
+            except RuntimeError:
+                pass  # event loop уже остановлен — отправляем напрямую
+        return self._executor.submit(self._send_http, chat_id, text, parse_mode)
+    
+    def _send_http(self, chat_id, text, parse_mode="HTML"):
+        """Отправка напрямую в Bot API через keep-alive сессию"""
+        url = f"{self.api_url}/bot{self.token}/sendMessage"
+        payload = {
+            "chat_id": chat_id,
+            "text": text,
+            "parse_mode": parse_mode
+        }
+        try:
+            response = self._session.post(url, json=payload, timeout=self.timeout)
+            result = response.json()
+        except Exception as e:
+            return SendResult(False, description=str(e))
+        
+        if result.get("ok"):
+            return SendResult(True, message_id=result.get("result", {}).get("message_id"))
+        return SendResult(
+            False,
+            error_code=result.get("error_code", response.status_code),
+            description=result.get("description"),
+            retry_after=result.get("parameters", {}).get("retry_after")
+        )
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self):
+        """Сколько секунд ждать до появления токена (0 — токен есть)"""
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+    
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+class OutboundQueue:
+    """Ограниченная очередь отправки с общим лимитом и лимитом на чат, учетом retry_after и порядком внутри чата.
+    
+    Чаты доставляются параллельно (не больше SEND_POOL_SIZE отправок одновременно),
+    внутри чата в полете не больше одного сообщения — медленный чат не задерживает остальные.
+    """
+    
+    def __init__(self, sender, maxsize=OUTBOUND_QUEUE_SIZE):
+        self.sender = sender
+        self.maxsize = maxsize
+        self._condition = threading.Condition()
+        self._queues = OrderedDict()  # chat_id -> deque элементов, порядок обхода чатов
+        self._buckets = {}
+        self._cooldown_until = {}
+        self._global_bucket = TokenBucket(GLOBAL_RATE_PER_SECOND, GLOBAL_RATE_PER_SECOND)
+        self._size = 0
+        self._in_flight = set()
+        # Метрики
+        self.chat_stats = {}  # chat_id -> {"sent", "failed", "throttled", "last_error"}
+        self.max_depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.throttled = 0
+        self.waits = deque(maxlen=POLL_STATS_SIZE)
+        threading.Thread(target=self._run, name="outbound-queue", daemon=True).start()
+    
+    def _bucket_for(self, chat_id):
+        if chat_id not in self._buckets:
+            if str(chat_id).startswith("-"):
+                # Группы и каналы: GROUP_RATE_PER_MINUTE сообщений в минуту
+                self._buckets[chat_id] = TokenBucket(GROUP_RATE_PER_MINUTE / 60, GROUP_RATE_PER_MINUTE)
+            else:
+                self._buckets[chat_id] = TokenBucket(PRIVATE_RATE_PER_SECOND, PRIVATE_RATE_PER_SECOND)
+        return self._buckets[chat_id]
+    
+    def put(self, chat_id, text, timeout=OUTBOUND_PUT_TIMEOUT):
+        """Постановка сообщения в очередь; возвращает Future с SendResult"""
+        future = Future()
+        chat_id = normalize_chat_id(chat_id)
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._size < self.maxsize, timeout):
+                future.set_result(SendResult(False, description="очередь отправки переполнена"))
+                return future
+            item = {"text": text, "future": future, "queued_at": time.monotonic(), "attempts": 0}
+            self._queues.setdefault(chat_id, deque()).append(item)
+            self._size += 1
+            self.max_depth = max(self.max_depth, self._size)
+            self._condition.notify_all()
+        return future
+    
+    def _next_item(self):
+        """Выбор следующего сообщения (под блокировкой): (chat_id, item) или время ожидания"""
+        now = time.monotonic()
+        if len(self._in_flight) >= SEND_POOL_SIZE:
+            return None, None
+        global_wait = self._global_bucket.wait_time()
+        min_wait = None
+        for chat_id, items in self._queues.items():
+            if not items or chat_id in self._in_flight:
+                continue
+            wait = max(self._cooldown_until.get(chat_id, 0) - now, self._bucket_for(chat_id).wait_time(), global_wait)
+            if wait <= 0:
+                # Переносим чат в конец порядка обхода, чтобы чаты чередовались
+                self._queues.move_to_end(chat_id)
+                return chat_id, items.popleft()
+            min_wait = wait if min_wait is None else min(min_wait, wait)
+        return None, min_wait
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    chat_id, item = self._next_item()
+                    if chat_id is not None:
+                        break
+                    self._condition.wait(item)
+                self._global_bucket.consume()
+                self._bucket_for(chat_id).consume()
+                self._in_flight.add(chat_id)
+            
+            item["attempts"] += 1
+            item["sent_at"] = time.monotonic()
+            future = self.sender.submit(chat_id, item["text"])
+            future.add_done_callback(lambda done, chat_id=chat_id, item=item: self._on_sent(chat_id, item, done))
+    
+    def _on_sent(self, chat_id, item, done):
+        """Обработка ответа Telegram: повтор, учет в статистике и завершение Future элемента"""
+        try:
+            result = done.result()
+        except Exception as e:
+            result = SendResult(False, description=str(e))
+        SEND_LATENCY.observe(time.monotonic() - item["sent_at"])
+        SEND_RESPONSES.inc(code="200" if result else str(result.error_code or "network"))
+        
+        with self._condition:
+            self._in_flight.discard(chat_id)
+            self._condition.notify_all()
+            chat_stats = self.chat_stats.setdefault(chat_id, {"sent": 0, "failed": 0, "throttled": 0, "last_error": None})
+            retry_delay = None
+            if result.error_code == 429:
+                self.throttled += 1
+                chat_stats["throttled"] += 1
+                item["attempts"] -= 1
+                retry_delay = result.retry_after or 1
+            elif not result and (result.error_code is None or result.error_code >= 500) \
+                    and item["attempts"] < SEND_MAX_ATTEMPTS:
+                retry_delay = 2 ** item["attempts"]
+            
+            if retry_delay is not None:
+                # Возвращаем в начало очереди чата: порядок сообщений сохраняется
+                self._cooldown_until[chat_id] = time.monotonic() + retry_delay
+                self._queues[chat_id].appendleft(item)
+                return
+            
+            self._size -= 1
+            if result:
+                self.sent += 1
+                chat_stats["sent"] += 1
+            else:
+                self.failed += 1
+                chat_stats["failed"] += 1
+                chat_stats["last_error"] = f"{result.error_code} {result.description}"
+            self.waits.append(time.monotonic() - item["queued_at"])
+        item["future"].set_result(result)
+    
+    @property
+    def depth(self):
+        """Сообщений в очереди и в отправке"""
+        return self._size
+    
+    def get_stats(self):
+        """Метрики очереди для панели производительности"""
+        with self._condition:
+            stats = {
+                "depth": self._size,
+                "max_depth": self.max_depth,
+                "sent": self.sent,
+                "failed": self.failed,
+                "throttled": self.throttled
+            }
+            waits = list(self.waits)
+            stats["chats"] = {chat_id: dict(chat_stats) for chat_id, chat_stats in self.chat_stats.items()}
+            stats["chats_pending"] = {chat_id: len(items) for chat_id, items in self._queues.items() if items}
+        if waits:
+            stats["wait_avg"] = sum(waits) / len(waits)
+            stats["wait_max"] = max(waits)
+        return stats
+
+class MessageCoalescer:
+    """Склейка подряд идущих сообщений одного чата в одно сообщение Telegram по размеру и времени"""
+    
+    def __init__(self, sink, window=COALESCE_WINDOW_SECONDS, limit=TELEGRAM_MESSAGE_LIMIT,
+                 prefix=FORWARD_PREFIX, separator=COALESCE_SEPARATOR):
+        self.sink = sink  # sink(chat_id, text) -> Future с SendResult
+        self.window = window
+        self.limit = limit
+        self.prefix = prefix
+        self.separator = separator
+        self._condition = threading.Condition()
+        # (chat_id, заголовок) -> {"chat_id", "header", "parts": [(text, future)], "length", "started"}
+        self._buffers = {}
+        # Метрики
+        self.messages_in = 0
+        self.packets_out = 0
+        threading.Thread(target=self._run, name="coalescer", daemon=True).start()
+    
+    def add(self, chat_id, text, prefix=None):
+        """Добавление сообщения; возвращает Future с SendResult итоговой отправки"""
+        future = Future()
+        # Пачка отправляется с parse_mode=HTML: текст MAX и префикс экранируются, длина считается после этого
+        header = f"{escape_html_truncated(prefix or self.prefix, PREFIX_MAX_LENGTH)}\n"
+        header_length = utf16_length(header)
+        text = escape_html_truncated(text, self.limit - header_length)
+        text_length = utf16_length(text)
+        key = (chat_id, header)
+        ready = []
+        
+        with self._condition:
+            self.messages_in += 1
+            buffer = self._buffers.get(key)
+            # Не помещается в текущую пачку: отправляем ее и начинаем новую
+            if buffer and buffer["length"] + utf16_length(self.separator) + text_length > self.limit:
+                ready.append(self._buffers.pop(key))
+                buffer = None
+            if buffer is None:
+                buffer = {"chat_id": chat_id, "header": header, "parts": [],
+                          "length": header_length, "started": time.monotonic()}
+                self._buffers[key] = buffer
+            else:
+                buffer["length"] += utf16_length(self.separator)
+            buffer["parts"].append((text, future))
+            buffer["length"] += text_length
+            
+            if self.window <= 0:
+                ready.append(self._buffers.pop(key))
+            self._condition.notify()
+        
+        for ready_buffer in ready:
+            self._send(ready_buffer)
+        return future
+    
+    def _send(self, buffer):
+        """Отправка пачки; результат раздается всем вошедшим в нее сообщениям"""
+        parts = buffer["parts"]
+        text = buffer["header"] + self.separator.join(part for part, _ in parts)
+        with self._condition:
+            self.packets_out += 1
+        
+        def resolve(done):
+            result = done.result()
+            for _, future in parts:
+                future.set_result(result)
+        
+        self.sink(buffer["chat_id"], text).add_done_callback(resolve)
+    
+    def _run(self):
+        """Отправка пачек по истечении окна склейки"""
+        while True:
+            ready = []
+            with self._condition:
+                while not self._buffers:
+                    self._condition.wait()
+                now = time.monotonic()
+                next_deadline = None
+                for key, buffer in list(self._buffers.items()):
+                    deadline = buffer["started"] + self.window
+                    if deadline <= now:
+                        ready.append(self._buffers.pop(key))
+                    elif next_deadline is None or deadline < next_deadline:
+                        next_deadline = deadline
+                if not ready:
+                    self._condition.wait(next_deadline - now)
+            for buffer in ready:
+                self._send(buffer)
+    
+    def flush_all(self):
+        """Немедленная отправка всех накопленных пачек"""
+        with self._condition:
+            ready = list(self._buffers.values())
+            self._buffers.clear()
+        for buffer in ready:
+            self._send(buffer)
+    
+    def get_stats(self):
+        with self._condition:
+            return {
+                "messages_in": self.messages_in,
+                "packets_out": self.packets_out,
+                "packing_ratio": self.messages_in / self.packets_out if self.packets_out else 0
+            }
+
+class DurableOutbox:
+    """Журнал исходящих сообщений (append-only JSONL): add при извлечении, ack после ok от Telegram.
+    
+    Подтверждения пишет фоновый поток пачками (один fsync на пачку): ack вызывается из
+    обратного вызова отправки, в том числе в event loop бота. Чат, сообщение в который не
+    ушло, придерживается до его успешной переотправки, чтобы порядок сообщений сохранился.
+    """
+    
+    def __init__(self, path=OUTBOX_FILE, compact_threshold=OUTBOX_COMPACT_THRESHOLD):
+        self.path = path
+        self.compact_threshold = compact_threshold
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()  # id -> запись, в порядке добавления
+        self._in_flight = set()
+        self._held = {}  # chat_id -> id первой неотправленной записи чата
+        self._acked = 0
+        self._next_id = 1
+        self._damaged = False
+        self.known_hashes = []  # (ключ истории, hash) всех записей журнала для восстановления дедупликации
+        self._load()
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if self._damaged or self._acked >= self.compact_threshold:
+            # Оборванная строка переписывается, иначе следующая запись продолжит ее
+            self.compact()
+        self._ack_queue = queue.Queue()
+        threading.Thread(target=self._write_acks, name="outbox-acks", daemon=True).start()
+    
+    def _load(self):
+        """Чтение журнала; оборванная последняя строка (падение при записи) пропускается"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    # Запись строки не дошла до конца: строка могла оборваться и на целом JSON
+                    logger.warning("Пропущена оборванная последняя строка журнала отправки")
+                    self._damaged = True
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning("Пропущена поврежденная строка журнала отправки")
+                    self._damaged = True
+                    continue
+                if record["op"] == "add":
+                    self._pending[record["id"]] = record
+                    self._next_id = max(self._next_id, record["id"] + 1)
+                    if record.get("hash"):
+                        # Записи прежних версий без ключа относились к первой группе (ключ — chat_id)
+                        self.known_hashes.append((record.get("dedup_key") or record["chat_id"], record["hash"]))
+                elif record["op"] == "ack":
+                    if self._pending.pop(record["id"], None) is not None:
+                        self._acked += 1
+        if self._pending:
+            logger.info(f"В журнале отправки {len(self._pending)} неподтвержденных сообщений")
+    
+    def _write(self, records):
+        self._file.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+    
+    def append(self, items):
+        """Запись новых сообщений [(chat_id, text, hash, prefix, dedup_key)] одним fsync; возвращает записи журнала"""
+        with self._lock:
+            records = []
+            for chat_id, text, message_hash, prefix, dedup_key in items:
+                record = {"op": "add", "id": self._next_id, "chat_id": chat_id, "dedup_key": dedup_key,
+                          "text": text, "hash": message_hash, "prefix": prefix, "at": time.time()}
+                self._next_id += 1
+                self._pending[record["id"]] = record
+                records.append(record)
+            if records:
+                self._write(records)
+            return records
+    
+    def claim(self, records):
+        """Записи для отправки сейчас (отмечаются как отправляемые); записи придержанных чатов ждут переотправки"""
+        with self._lock:
+            ready = [record for record in records if record["chat_id"] not in self._held]
+            self._in_flight.update(record["id"] for record in ready)
+            return ready
+    
+    def release(self, entry_id):
+        """Отправка не удалась: запись останется в журнале, чат придерживается до ее переотправки"""
+        with self._lock:
+            self._in_flight.discard(entry_id)
+            record = self._pending.get(entry_id)
+            if record is not None:
+                held_id = self._held.get(record["chat_id"])
+                if held_id is None or entry_id < held_id:
+                    self._held[record["chat_id"]] = entry_id
+    
+    def ack(self, entry_id):
+        """Подтверждение доставки (или окончательного отказа) записи; True, если чат больше не придержан"""
+        with self._lock:
+            self._in_flight.discard(entry_id)
+            record = self._pending.pop(entry_id, None)
+            if record is None:
+                return False
+            released = self._held.get(record["chat_id"]) == entry_id
+            if released:
+                del self._held[record["chat_id"]]
+        self._ack_queue.put(entry_id)
+        return released
+    
+    def _write_acks(self):
+        while True:
+            entry_ids = [self._ack_queue.get()]
+            while not self._ack_queue.empty():
+                entry_ids.append(self._ack_queue.get_nowait())
+            try:
+                with self._lock:
+                    self._write([{"op": "ack", "id": entry_id} for entry_id in entry_ids])
+                    self._acked += len(entry_ids)
+                    need_compact = self._acked >= self.compact_threshold
+                if need_compact:
+                    self.compact()
+            except Exception as e:
+                logger.error(f"Ошибка записи подтверждений в журнал отправки: {e}")
+            finally:
+                for _ in entry_ids:
+                    self._ack_queue.task_done()
+    
+    def flush(self):
+        """Ожидание записи всех подтверждений на диск"""
+        self._ack_queue.join()
+    
+    def take_pending(self):
+        """Неподтвержденные записи, которые сейчас не отправляются, в порядке добавления.
+        
+        Из придержанного чата берется только первая запись: остальные уйдут после ее подтверждения.
+        """
+        with self._lock:
+            entries = []
+            held_taken = set()
+            for entry_id, record in self._pending.items():
+                chat_id = record["chat_id"]
+                if chat_id in self._held:
+                    if chat_id in held_taken:
+                        continue
+                    held_taken.add(chat_id)
+                if entry_id not in self._in_flight:
+                    entries.append(record)
+            self._in_flight.update(record["id"] for record in entries)
+            return entries
+    
+    def compact(self):
+        """Перезапись журнала только с неподтвержденными записями"""
+        with self._lock:
+            self._file.close()
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for record in self._pending.values():
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self._file = open(self.path, 'a', encoding='utf-8')
+            self._acked = 0
+            self._damaged = False
+    
+    def get_stats(self):
+        with self._lock:
+            return {"pending": len(self._pending), "in_flight": len(self._in_flight), "held_chats": len(self._held)}
+
+WORD_PATTERN = re.compile(r"\w+")
+
+def keyword_tokens(text):
+    """Слова текста в нижнем регистре (ключевые слова маршрутов сравниваются по целым словам)"""
+    return WORD_PATTERN.findall(text.lower())
+
+class RouteMatcher:
+    """Скомпилированная таблица маршрутов: источник MAX -> чаты Telegram с условиями по автору и словам.
+    
+    Все условия собраны в общие индексы (словари источников, авторов и ключевых слов).
+    Текст разбивается на слова один раз, и каждое слово (или фраза из нескольких слов)
+    ищется в словаре ключевых слов, поэтому проверка сообщения стоит одинаково при 3
+    и при 300 маршрутах.
+    """
+    
+    def __init__(self, routes):
+        self.routes = []
+        self._unconditional = {}  # источник -> маршруты без условий
+        self._by_author = {}  # автор (в нижнем регистре) -> маршруты
+        self._by_keyword = {}  # ключевое слово (в нижнем регистре) -> маршруты
+        for index, route in enumerate(routes):
+            compiled = {
+                "index": index,
+                "source": route.get("source") or "*",
+                "targets": [normalize_chat_id(chat_id) for chat_id in route.get("targets", [])],
+                "authors": {author.lower() for author in route.get("authors", [])},
+                # Ключевое слово из нескольких слов хранится как фраза через пробел
+                "keywords": {" ".join(keyword_tokens(keyword)) for keyword in route.get("keywords", [])} - {""},
+                "prefix": route.get("prefix") or FORWARD_PREFIX
+            }
+            self.routes.append(compiled)
+            if compiled["authors"]:
+                for author in compiled["authors"]:
+                    self._by_author.setdefault(author, []).append(compiled)
+            elif compiled["keywords"]:
+                for keyword in compiled["keywords"]:
+                    self._by_keyword.setdefault(keyword, []).append(compiled)
+            else:
+                self._unconditional.setdefault(compiled["source"], []).append(compiled)
+        
+        # Самая длинная фраза ограничивает число сочетаний слов текста, которые нужно проверить
+        self._max_phrase_words = max((len(keyword.split()) for keyword in self._by_keyword), default=0)
+        self._phrase_starts = {keyword.split()[0] for keyword in self._by_keyword if " " in keyword}
+    
+    def __bool__(self):
+        return bool(self.routes)
+    
+    def match(self, source, message):
+        """Список (chat_id, префикс) для сообщения; первый подходящий маршрут задает префикс чата"""
+        found_keywords = set()
+        if self._by_keyword:
+            words = keyword_tokens(message["text"])
+            found_keywords = self._by_keyword.keys() & words
+            if self._phrase_starts:
+                for start, word in enumerate(words):
+                    if word not in self._phrase_starts:
+                        continue
+                    for length in range(2, self._max_phrase_words + 1):
+                        phrase = " ".join(words[start:start + length])
+                        if phrase in self._by_keyword:
+                            found_keywords.add(phrase)
+        
+        candidates = self._unconditional.get(source, []) + self._unconditional.get("*", [])
+        candidates += self._by_author.get(message["author"].lower(), [])
+        for keyword in found_keywords:
+            candidates += self._by_keyword.get(keyword, [])
+        
+        deliveries = {}
+        for route in sorted(candidates, key=lambda route: route["index"]):
+            if route["source"] not in ("*", source):
+                continue
+            if route["keywords"] and not route["keywords"] & found_keywords:
+                continue
+            for chat_id in route["targets"]:
+                deliveries.setdefault(chat_id, route["prefix"])
+        return list(deliveries.items())
+
+SPARKLINE_CHARS = "▁▂▃▄▅▆▇█"
+
+def sparkline(values, width=SPARKLINE_WIDTH):
+    """График тренда из символов; значения усредняются до width точек"""
+    values = list(values)
+    if not values:
+        return ""
+    if len(values) > width:
+        step = len(values) / width
+        values = [statistics.fmean(values[int(i * step):int((i + 1) * step)]) for i in range(width)]
+    low, high = min(values), max(values)
+    scale = (high - low) or 1
+    return "".join(SPARKLINE_CHARS[int((value - low) / scale * (len(SPARKLINE_CHARS) - 1))] for value in values)
+
+class MetricsSampler:
+    """Фоновые замеры ресурсов бота, браузера и хоста в кольцевые буферы фиксированного размера"""
+    
+    METRICS = ("cpu_percent", "bot_cpu_percent", "bot_rss_mb", "browser_cpu_percent", "browser_rss_mb",
+               "memory_percent", "disk_percent", "net_recv_kbps", "net_sent_kbps")
+    
+    def __init__(self, interval=METRICS_SAMPLE_INTERVAL, history_size=METRICS_HISTORY_SIZE):
+        self.interval = interval
+        self.history = {name: deque(maxlen=history_size) for name in self.METRICS}
+        self.latest = {}
+        self._lock = threading.Lock()
+        self._process = psutil.Process()
+        self._children = {}  # pid -> psutil.Process: cpu_percent считает от прошлого вызова того же объекта
+        self._last_net = None
+        self._thread = None
+    
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="metrics-sampler", daemon=True)
+            self._thread.start()
+    
+    def _run(self):
+        # Первый вызов cpu_percent(None) задает точку отсчета и возвращает 0
+        psutil.cpu_percent(interval=None)
+        self._process.cpu_percent(interval=None)
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sample()
+            except Exception as e:
+                logger.warning(f"Ошибка сбора метрик: {e}")
+    
+    def _browser_processes(self):
+        """Дочерние процессы браузера (chromedriver и Chrome запускаются потомками бота)"""
+        processes = []
+        alive = set()
+        for child in self._process.children(recursive=True):
+            try:
+                name = child.name().lower()
+                if not any(browser_name in name for browser_name in BROWSER_PROCESS_NAMES):
+                    continue
+            except psutil.Error:
+                continue
+            process = self._children.get(child.pid)
+            if process is None:
+                process = self._children[child.pid] = child
+                process.cpu_percent(interval=None)
+            processes.append(process)
+            alive.add(child.pid)
+        for pid in set(self._children) - alive:
+            del self._children[pid]
+        return processes
+    
+    def sample(self):
+        """Один замер всех метрик"""
+        now = time.monotonic()
+        browser_cpu = 0.0
+        browser_rss = 0
+        browser_count = 0
+        for process in self._browser_processes():
+            try:
+                browser_cpu += process.cpu_percent(interval=None)
+                browser_rss += process.memory_info().rss
+                browser_count += 1
+            except psutil.Error:
+                continue
+        
+        memory = psutil.virtual_memory()
+        disk = psutil.disk_usage('/')
+        net = psutil.net_io_counters()
+        net_recv = net_sent = 0.0
+        if self._last_net:
+            last_time, last_counters = self._last_net
+            elapsed = max(now - last_time, 1e-6)
+            net_recv = (net.bytes_recv - last_counters.bytes_recv) / elapsed / 1024
+            net_sent = (net.bytes_sent - last_counters.bytes_sent) / elapsed / 1024
+        self._last_net = (now, net)
+        
+        values = {
+            "cpu_percent": psutil.cpu_percent(interval=None),
+            "bot_cpu_percent": self._process.cpu_percent(interval=None),
+            "bot_rss_mb": self._process.memory_info().rss / (1024 ** 2),
+            "browser_cpu_percent": browser_cpu,
+            "browser_rss_mb": browser_rss / (1024 ** 2),
+            "memory_percent": memory.percent,
+            "disk_percent": disk.percent,
+            "net_recv_kbps": net_recv,
+            "net_sent_kbps": net_sent
+        }
+        with self._lock:
+            for name, value in values.items():
+                self.history[name].append(value)
+            self.latest = {
+                **values,
+                "browser_processes": browser_count,
+                "memory_total": memory.total,
+                "memory_used": memory.used,
+                "disk_total": disk.total,
+                "disk_used": disk.used,
+                "sampled_at": time.time()
+            }
+        return values
+    
+    def get_latest(self):
+        """Последний замер (пустой словарь до первого замера)"""
+        with self._lock:
+            return dict(self.latest)
+    
+    def get_stats(self):
+        """min/avg/max и график тренда по каждой метрике за всю историю"""
+        with self._lock:
+            history = {name: list(values) for name, values in self.history.items()}
+            latest = dict(self.latest)
+        stats = {"samples": len(history["cpu_percent"]), "interval": self.interval, "latest": latest, "metrics": {}}
+        for name, values in history.items():
+            if values:
+                stats["metrics"][name] = {
+                    "min": min(values),
+                    "avg": statistics.fmean(values),
+                    "max": max(values),
+                    "trend": sparkline(values)
+                }
+        return stats
+
+def get_max_groups():
+    """Список групп MAX для пересылки"""
+    return list(MAX_GROUP_URLS) or [MAX_GROUP_URL]
+
+class SnapshotRecorder:
+    """Запись снимков страницы группы и найденных на ней сообщений в сжатый файл (gzip, JSON по строке).
+    
+    Сжатие и запись выполняет фоновый поток, в такте остается только получение HTML страницы.
+    """
+    
+    def __init__(self, path, every_ticks=SNAPSHOT_EVERY_TICKS, max_mb=SNAPSHOT_MAX_MB):
+        self.path = path
+        self.every_ticks = max(1, every_ticks)
+        self.max_bytes = max_mb * 1024 ** 2
+        self.full = False
+        self.recorded = 0
+        self.dropped = 0
+        self._ticks = 0
+        self._queue = queue.Queue(maxsize=SNAPSHOT_QUEUE_SIZE)
+        threading.Thread(target=self._run, name="snapshot-recorder", daemon=True).start()
+    
+    def due(self):
+        """Нужно ли записывать снимок в этом такте"""
+        self._ticks += 1
+        return not self.full and self._ticks % self.every_ticks == 0
+    
+    def record(self, group, html, candidates):
+        snapshot = {
+            "at": time.time(),
+            "group": group,
+            "capture_mode": CAPTURE_MODE,
+            "extraction_mode": EXTRACTION_MODE,
+            "html": html,
+            "candidates": candidates
+        }
+        try:
+            self._queue.put_nowait(snapshot)
+        except queue.Full:
+            self.dropped += 1
+    
+    def _run(self):
+        while True:
+            snapshots = [self._queue.get()]
+            while not self._queue.empty():
+                snapshots.append(self._queue.get_nowait())
+            # Каждая пачка — отдельный член gzip: файл остается читаемым при любой остановке бота
+            with gzip.open(self.path, 'at', encoding='utf-8') as f:
+                for snapshot in snapshots:
+                    f.write(json.dumps(snapshot, ensure_ascii=False) + "\n")
+            self.recorded += len(snapshots)
+            if os.path.getsize(self.path) >= self.max_bytes:
+                self.full = True
+                logger.warning(f"Запись снимков остановлена: файл {self.path} достиг {SNAPSHOT_MAX_MB} МБ")
+                return
+
+class GroupTab:
+    """Вкладка браузера с группой MAX: свой интервал опроса, политика обновления и статистика"""
+    
+    def __init__(self, url):
+        self.url = url
+        self.handle = None
+        self.scheduler = AdaptivePollScheduler()
+        self.refresh_policy = PageRefreshPolicy()
+        self.next_due = 0
+        self.forwarded = 0
 
 class MaxToTelegramForwarder:
-    def __init__(self, bot_settings):
+    def __init__(self, bot_settings, max_url=MAX_BASE_URL, group_urls=None, telegram_api_url=TELEGRAM_API_URL,
+                 telegram_token=TELEGRAM_BOT_TOKEN, outbox_path=OUTBOX_FILE, headless=BROWSER_HEADLESS,
+                 snapshot_path=SNAPSHOT_FILE):
+        # Адреса MAX и Bot API можно подменить (например, локальными заглушками для замеров)
         self.settings = bot_settings
+        self.max_url = max_url
+        self.headless = headless
         self.driver = None
-        self.is_ready = False
+        self._is_ready = False
+        self.ready_event = None
         self.forwarding_active = False
         self.application = None
+        self.task = None
+        self._task_loop = None
+        # Один поток на все команды WebDriver: драйвер не используется из двух потоков сразу
+        self._browser_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="selenium")
+        self.tabs = [GroupTab(url) for url in (group_urls or get_max_groups())]
+        self.current_tab = self.tabs[0]
+        self.sender = TelegramSender(token=telegram_token, api_url=telegram_api_url)
+        self.outbound = OutboundQueue(self.sender)
+        self.coalescer = MessageCoalescer(
+            self.outbound.put, window=COALESCE_WINDOW_SECONDS if COALESCE_ENABLED else 0
+        )
+        self.outbox = DurableOutbox(outbox_path)
+        self.stage_stats = StageStats()
+        self.snapshot_recorder = SnapshotRecorder(snapshot_path) if snapshot_path else None
+        self.last_outbox_replay = time.monotonic()
+        # Сообщения из журнала уже извлекались: не пересылаем их повторно после перезапуска
+        for dedup_key, message_hash in self.outbox.known_hashes:
+            self.settings.add_processed_message(dedup_key, message_hash)
         
+    @property
+    def poll_scheduler(self):
+        """Планировщик опроса текущей вкладки"""
+        return self.current_tab.scheduler
+    
+    @property
+    def refresh_policy(self):
+        """Политика обновления страницы текущей вкладки"""
+        return self.current_tab.refresh_policy
+    
     def setup_selenium(self):
         """Настройка Selenium WebDriver"""
         try:
@@ -136,9 +2037,15 @@ class MaxToTelegramForwarder:
             chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
             chrome_options.add_experimental_option('useAutomationExtension', False)
             chrome_options.add_argument("--start-maximized")
+            if self.headless:
+                chrome_options.add_argument("--headless=new")
+            if BROWSER_PROFILE_DIR:
+                chrome_options.add_argument(f"--user-data-dir={os.path.abspath(BROWSER_PROFILE_DIR)}")
             
             self.driver = webdriver.Chrome(options=chrome_options)
             self.driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
+            # Запас сверх максимального ожидания очереди наблюдателя
+            self.driver.set_script_timeout(POLL_MAX_INTERVAL_LIMIT + 10)
             logger.info("Браузер запущен")
             return True
         except Exception as e:
@@ -150,7 +2057,7 @@ class MaxToTelegramForwarder:
     def open_max(self):
         """Открытие MAX в браузере"""
         try:
-            self.driver.get("https://web.max.ru")
+            self.driver.get(self.max_url)
             logger.info("MAX открыт в браузере")
             return True
         except Exception as e:
@@ -159,27 +2066,59 @@ class MaxToTelegramForwarder:
             self.send_admin_message(f"❌ {error_msg}")
             return False
     
-    def navigate_to_group(self):
+    @property
+    def is_ready(self):
+        """Вход в MAX выполнен (кнопка 'Я вошел' или автоматическое определение)"""
+        return self._is_ready
+    
+    @is_ready.setter
+    def is_ready(self, value):
+        # Можно вызывать из любого потока: событие будится в event loop задачи пересылки
+        self._is_ready = value
+        loop, event = self._task_loop, self.ready_event
+        if value and event and loop and not loop.is_closed():
+            loop.call_soon_threadsafe(event.set)
+    
+    def is_logged_in(self):
+        """Проверка признаков входа на странице (выполняется в потоке браузера)"""
+        return bool(self.driver.execute_script(LOGIN_CHECK_SCRIPT, ", ".join(LOGIN_READY_SELECTORS)))
+    
+    async def wait_for_login(self):
+        """Ожидание входа: событие от кнопки 'Я вошел' или от проверки страницы"""
+        detector = None
+        if self.settings.settings.get("login_auto_detect", LOGIN_AUTO_DETECT):
+            detector = asyncio.create_task(self.detect_login())
+        try:
+            await self.ready_event.wait()
+        finally:
+            if detector:
+                detector.cancel()
+    
+    async def detect_login(self):
+        """Периодическая проверка страницы на признаки входа; при успехе — то же, что кнопка 'Я вошел'"""
+        while not self.ready_event.is_set():
+            try:
+                if await self.browser_call(self.is_logged_in):
+                    logger.info("Вход в MAX определен автоматически")
+                    self.is_ready = True
+                    await self.send_admin_message_async("✅ Вход в MAX определен автоматически")
+                    return
+            except Exception as e:
+                logger.debug(f"Проверка входа не удалась: {e}")
+            await asyncio.sleep(LOGIN_CHECK_INTERVAL)
+    
+    def navigate_to_group(self, url=None):
         """Переход к конкретной группе в MAX по прямому URL"""
+        url = url or self.current_tab.url
         try:
-            logger.info(f"Переход в группу: {MAX_GROUP_URL}")
-            self.driver.get(MAX_GROUP_URL)
-            time.sleep(5)
-            
-            # Проверяем, что загрузилась страница группы
-            chat_indicators = [
-                "input[placeholder*='сообщени']",
-                "input[placeholder*='message']",
-                "div[contenteditable='true']",
-                "[class*='message']",
-                "[class*='chat']"
-            ]
+            logger.info(f"Переход в группу: {url}")
+            self.driver.get(url)
             
-            for indicator in chat_indicators:
-                elements = self.driver.find_elements(By.CSS_SELECTOR, indicator)
-                if elements:
-                    logger.info("Успешно перешли в группу MAX")
-                    return True
+            # Ждем, пока загрузится страница группы
+            ready_seconds = self.wait_page_ready()
+            if ready_seconds is not None:
+                logger.info(f"Успешно перешли в группу MAX за {ready_seconds:.2f} с")
+                return True
             
             logger.warning("Не удалось подтвердить переход в группу, но продолжаем...")
             return True
@@ -190,27 +2129,72 @@ class MaxToTelegramForwarder:
             self.send_admin_message(f"❌ {error_msg}")
             return False
     
+    def wait_page_ready(self):
+        """Ожидание готовности страницы группы; время до готовности в секундах или None по таймауту"""
+        timeout = self.settings.settings.get("page_ready_timeout", PAGE_READY_TIMEOUT)
+        selectors = ", ".join(PAGE_READY_SELECTORS)
+        started = time.monotonic()
+        try:
+            WebDriverWait(self.driver, timeout, poll_frequency=PAGE_READY_POLL_INTERVAL).until(
+                lambda driver: driver.execute_script(PAGE_READY_SCRIPT, selectors)
+            )
+        except TimeoutException:
+            PAGE_READY_TIMEOUTS.inc()
+            return None
+        ready_seconds = time.monotonic() - started
+        PAGE_READY_DURATION.observe(ready_seconds)
+        return ready_seconds
+    
+    def open_group_tabs(self):
+        """Открытие каждой группы MAX в своей вкладке одного браузера"""
+        for index, tab in enumerate(self.tabs):
+            if index > 0:
+                self.driver.switch_to.new_window('tab')
+            tab.handle = self.driver.current_window_handle
+            self.current_tab = tab
+            if not self.navigate_to_group(tab.url):
+                return False
+            tab.refresh_policy.reset()
+            tab.next_due = time.monotonic()
+            if CAPTURE_MODE == "observer":
+                self.install_message_observer()
+        return True
+    
+    def switch_to_tab(self, tab):
+        """Переключение WebDriver на вкладку группы (без запроса, если она уже текущая)"""
+        if tab is not self.current_tab:
+            self.driver.switch_to.window(tab.handle)
+            self.current_tab = tab
+    
+    def next_tab(self):
+        """Вкладка, чей срок опроса наступает раньше всех.
+        
+        У каждой вкладки свой адаптивный интервал, поэтому активные группы
+        опрашиваются чаще, а молчащие — все реже, до потолка интервала.
+        """
+        return min(self.tabs, key=lambda tab: tab.next_due)
+    
+    def dedup_key(self, chat_id, tab):
+        """Ключ истории обработанных сообщений: отдельный для каждой пары группа MAX — чат Telegram.
+        
+        Первая группа использует просто chat_id, чтобы сохранить историю, накопленную до вкладок.
+        """
+        if tab is self.tabs[0]:
+            return normalize_chat_id(chat_id)
+        return f"{normalize_chat_id(chat_id)}|{tab.url}"
+    
     def send_to_telegram(self, text, chat_id=None):
-        """Отправка сообщения в Telegram через бота"""
+        """Отправка сообщения в Telegram через бота (возвращает SendResult)"""
         if not chat_id:
             chat_id = self.settings.settings.get("selected_chat_id")
             if not chat_id:
                 logger.error("Не выбран чат для отправки")
-                return False
+                return SendResult(False, description="Не выбран чат для отправки")
         
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        payload = {
-            "chat_id": chat_id,
-            "text": text,
-            "parse_mode": "HTML"
-        }
-        try:
-            response = requests.post(url, json=payload, timeout=10)
-            result = response.json()
-            return result.get("ok", False)
-        except Exception as e:
-            logger.error(f"Ошибка отправки в Telegram: {e}")
-            return False
+        result = self.sender.send(chat_id, text)
+        if not result:
+            logger.error(f"Ошибка отправки в Telegram ({chat_id}): {result.error_code} {result.description}")
+        return result
     
     def send_admin_message(self, text):
         """Отправка сообщения админу"""
@@ -218,157 +2202,440 @@ class MaxToTelegramForwarder:
         if admin_chat_id:
             self.send_to_telegram(text, admin_chat_id)
     
+    async def send_admin_message_async(self, text):
+        """Отправка сообщения админу из обработчиков бота (не блокирует event loop)"""
+        admin_chat_id = self.settings.settings.get("admin_chat_id")
+        if admin_chat_id:
+            result = await self.sender.send_async(admin_chat_id, text)
+            if not result:
+                logger.error(f"Ошибка отправки админу: {result.error_code} {result.description}")
+    
     def extract_messages_from_max(self):
         """Извлечение сообщений из группы MAX"""
         messages = []
+        started = time.monotonic()
         
         try:
-            # Ищем все элементы, которые могут быть сообщениями
-            all_elements = self.driver.find_elements(By.CSS_SELECTOR, "[class]")
+            if EXTRACTION_MODE == "script":
+                # Один запрос к WebDriver: фильтрация выполняется внутри страницы
+                result = self.driver.execute_script(
+                    EXTRACT_MESSAGES_SCRIPT,
+                    EXTRACTION_SCAN_LIMIT, MESSAGE_MIN_LENGTH, MESSAGE_MAX_LENGTH, MESSAGE_KEYWORDS
+                )
+                messages = [normalize_message(item) for item in result or []]
+            else:
+                # Ищем все элементы, которые могут быть сообщениями
+                all_elements = self.driver.find_elements(By.CSS_SELECTOR, "[class]")
+                
+                for element in all_elements[-EXTRACTION_SCAN_LIMIT:]:  # Проверяем последние элементы
+                    try:
+                        text = element.text.strip()
+                        if is_message_candidate(text):
+                            messages.append(normalize_message(text))
+                    except:
+                        continue
             
-            for element in all_elements[-50:]:  # Проверяем последние 50 элементов
-                try:
-                    text = element.text.strip()
-                    # Фильтруем сообщения
-                    if (text and 
-                        len(text) > 5 and 
-                        len(text) < 1000 and
-                        not text.startswith("http")):
-                        
-                        if any(keyword in text.lower() for keyword in [':', 'написал', 'отправлено', 'message']):
-                            messages.append(text)
-                        elif len(text) > 20:
-                            messages.append(text)
-                            
-                except:
-                    continue
-                    
+            EXTRACTION_DURATION.observe(time.monotonic() - started)
+            self.refresh_policy.record_extraction(True)
         except Exception as e:
             error_msg = f"Ошибка извлечения сообщений: {e}"
             logger.error(error_msg)
+            self.refresh_policy.record_extraction(False)
             self.send_admin_message(f"❌ {error_msg}")
         
         return messages
     
+    def install_message_observer(self):
+        """Установка MutationObserver на странице группы"""
+        try:
+            if self.driver.execute_script(INSTALL_OBSERVER_SCRIPT, MESSAGE_MIN_LENGTH, MESSAGE_MAX_LENGTH, MESSAGE_KEYWORDS):
+                logger.info("Наблюдатель за новыми сообщениями установлен")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка установки наблюдателя: {e}")
+            return False
+    
+    def drain_observed_messages(self, wait_seconds):
+        """Получение сообщений из очереди наблюдателя (None, если наблюдатель не установлен)"""
+        result = self.driver.execute_async_script(DRAIN_OBSERVER_SCRIPT, int(wait_seconds * 1000))
+        if result is None:
+            return None
+        return [normalize_message(item) for item in result]
+    
+    async def wait_observed_messages(self, wait_seconds):
+        """Ожидание новых сообщений в очереди наблюдателя до wait_seconds (None — наблюдатель не установлен).
+        
+        Ожидание делится на части по OBSERVER_WAIT_SLICE: между частями задачу можно отменить,
+        и остановка не ждет окончания всей паузы внутри браузера.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait_seconds
+        while True:
+            remaining = max(0.0, deadline - loop.time())
+            try:
+                messages = await self.browser_call(self.drain_observed_messages, min(remaining, OBSERVER_WAIT_SLICE))
+            except Exception:
+                self.refresh_policy.record_extraction(False)
+                raise
+            if messages is None or messages or remaining <= OBSERVER_WAIT_SLICE:
+                return messages
+    
+    def collect_messages(self, observed):
+        """Сообщения такта согласно CAPTURE_MODE (observed — результат ожидания наблюдателя)"""
+        if CAPTURE_MODE != "observer":
+            return self.extract_messages_from_max()
+        
+        if observed is not None:
+            self.refresh_policy.record_extraction(True)
+            return observed
+        
+        # После refresh или перезапуска браузера наблюдатель пропадает: ставим заново
+        # и один раз сканируем DOM, чтобы не потерять сообщения, пришедшие до установки.
+        # Успех или ошибку сканирования учитывает extract_messages_from_max; если наблюдатель
+        # не установился, такт считается ошибкой (ровно одной) даже при удачном сканировании
+        installed = self.install_message_observer()
+        failures = self.refresh_policy.failures
+        messages = self.extract_messages_from_max()
+        if not installed:
+            self.refresh_policy.failures = failures + 1
+        return messages
+    
+    def refresh_page(self, reason):
+        """Обновление страницы группы с учетом в статистике"""
+        logger.info(f"Обновление страницы MAX: {reason}")
+        self.driver.refresh()
+        self.refresh_policy.record_refresh(reason)
+        PAGE_REFRESHES.inc()
+        ready_seconds = self.wait_page_ready()
+        if ready_seconds is None:
+            logger.warning("Страница MAX не загрузилась после обновления за отведенное время")
+    
     def get_message_hash(self, message):
         """Создание хеша для сообщения"""
-        return hashlib.md5(message.encode()).hexdigest()
+        message = normalize_message(message)
+        if message["id"]:
+            # Идентификатор из DOM MAX не зависит от текста и его перерисовки
+            key = f"id:{message['id']}"
+        elif message["ts"] or message["author"]:
+            key = f"{message['author']}\x1f{message['ts']}\x1f{message['text']}"
+        else:
+            # Без атрибутов хеш совпадает с прежним md5 текста, история остается валидной
+            key = message["text"]
+        return hashlib.md5(key.encode()).hexdigest()
+    
+    def is_forwarded_before(self, dedup_key, message, msg_hash):
+        """Проверка истории по хешу сообщения и по прежнему хешу текста.
+        
+        До появления id и времени из DOM история хранила md5 текста: без этой проверки первое
+        сканирование после обновления переслало бы заново все сообщения страницы с id.
+        Найденное по прежнему хешу записывается и под новым.
+        """
+        if self.settings.is_message_processed(dedup_key, msg_hash):
+            return True
+        legacy_hash = hashlib.md5(message["text"].encode()).hexdigest()
+        if legacy_hash != msg_hash and self.settings.is_message_processed(dedup_key, legacy_hash):
+            self.settings.add_processed_message(dedup_key, msg_hash)
+            return True
+        return False
+    
+    def select_messages_after_cursor(self, messages, cursor):
+        """Отбор сообщений, идущих после курсора последнего пересланного сообщения.
+        
+        Выше курсора отбрасываются только сообщения с id или временем: сообщения без них
+        (служебные строки, индикаторы) неотличимы от новых и всегда проходят дедупликацию.
+        """
+        # Курсор на сообщении без id и времени (из прежних версий) ненадежен: не используем
+        if not cursor or not (cursor.get("id") or cursor.get("ts")) or not messages:
+            return messages
+        
+        # Курсор найден на странице: берем все, что ниже него
+        for position in range(len(messages) - 1, -1, -1):
+            if self.get_message_hash(messages[position]) == cursor.get("hash"):
+                return [message for message in messages[:position] if not is_identified(message)] + messages[position + 1:]
+        
+        # Курсор ушел за пределы страницы: сравниваем по времени, если оно известно
+        cursor_ts = cursor.get("ts")
+        if cursor_ts:
+            return [message for message in messages
+                    if not message["ts"] or _compare_timestamps(message["ts"], cursor_ts) >= 0]
+        return messages
+    
+    async def browser_call(self, function, *args):
+        """Вызов Selenium в отдельном потоке браузера: все команды WebDriver идут строго по очереди"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._browser_executor, functools.partial(function, *args)
+        )
+    
+    def start(self):
+        """Запуск пересылки задачей в event loop бота; False, если она уже запущена"""
+        if self.forwarding_active:
+            return False
+        self.forwarding_active = True
+        # Не application.create_task: Application.stop ждет такие задачи, а пересылка бесконечна
+        # (ее отменяет post_stop)
+        self.task = asyncio.get_running_loop().create_task(self.run_forwarding(), name="max-forwarder")
+        self.task.add_done_callback(self._on_task_done)
+        return True
+    
+    def _on_task_done(self, task):
+        if not task.cancelled() and task.exception():
+            logger.error(f"Задача пересылки завершилась с ошибкой: {task.exception()}")
     
     def start_forwarding_process(self):
-        """Запуск процесса пересылки сообщений"""
+        """Пересылка в собственном event loop вызывающего потока (без бота Application, например на стенде)"""
         if self.forwarding_active:
             return
-        
         self.forwarding_active = True
-        
-        # Настраиваем Selenium
-        if not self.setup_selenium():
+        asyncio.run(self.run_forwarding())
+    
+    def quit_driver(self):
+        """Закрытие браузера (выполняется в потоке браузера)"""
+        if self.driver:
+            try:
+                self.driver.quit()
+            except Exception as e:
+                logger.warning(f"Ошибка закрытия браузера: {e}")
+            self.driver = None
+    
+    async def run_forwarding(self):
+        """Процесс пересылки сообщений: задача asyncio, команды браузера — в потоке браузера"""
+        self.task = asyncio.current_task()
+        self._task_loop = asyncio.get_running_loop()
+        self.ready_event = asyncio.Event()
+        if self.is_ready:
+            self.ready_event.set()
+        try:
+            # Настраиваем Selenium
+            if not await self.browser_call(self.setup_selenium):
+                return
+            
+            # Открываем MAX для входа
+            if not await self.browser_call(self.open_max):
+                return
+            
+            if not self.is_ready:
+                await self.send_admin_message_async(
+                    "🔐 Браузер открыт. Войдите в MAX вручную и нажмите кнопку 'Я вошел' в меню бота "
+                    "(вход определяется и автоматически)."
+                )
+            
+            # Ждем входа: кнопка 'Я вошел' или автоматическое определение
+            await self.wait_for_login()
+            
+            # Открываем группы, каждую в своей вкладке
+            if not await self.browser_call(self.open_group_tabs):
+                return
+            
+            # Начинаем пересылку
+            await self.send_admin_message_async("🚀 Начата пересылка сообщений из MAX!")
+            logger.info("Начата пересылка сообщений")
+            await self.forwarding_loop()
+        except asyncio.CancelledError:
+            logger.info("Пересылка отменена")
+        except Exception as e:
+            error_msg = f"Критическая ошибка: {e}"
+            logger.error(error_msg)
+            await self.send_admin_message_async(f"❌ {error_msg}")
+        finally:
             self.forwarding_active = False
-            return
+            self.is_ready = False
+            # Браузер закрывается в своем потоке после текущей команды: гонки с quit() нет
+            await asyncio.shield(self.browser_call(self.quit_driver))
+            # Досылка пачек может ждать места в заполненной очереди: не в event loop
+            await asyncio.to_thread(self.coalescer.flush_all)
+            await asyncio.to_thread(self.settings.flush)
+            await asyncio.to_thread(self.outbox.flush)
+            await self.send_admin_message_async("🛑 Пересылка сообщений остановлена")
+    
+    async def forwarding_loop(self):
+        """Основной цикл: ожидание и такты по вкладкам до отмены задачи"""
+        error_count = 0
+        while True:
+            try:
+                # Перезапуск при множественных ошибках подряд
+                if error_count >= 5:
+                    await self.send_admin_message_async("⚠️ Много ошибок, перезапускаю браузер...")
+                    BROWSER_RESTARTS.inc()
+                    await self.browser_call(self.quit_driver)
+                    await asyncio.sleep(BROWSER_RESTART_DELAY)
+                    if not await self.browser_call(self.setup_selenium) or not await self.browser_call(self.open_group_tabs):
+                        await self.send_admin_message_async("❌ Не удалось восстановить соединение")
+                        return
+                    error_count = 0
+                
+                # Границы интервала могли измениться в админ-панели
+                for tab in self.tabs:
+                    tab.scheduler.configure(
+                        self.settings.settings.get("poll_min_interval", POLL_MIN_INTERVAL),
+                        self.settings.settings.get("poll_max_interval", POLL_MAX_INTERVAL)
+                    )
+                
+                tab = self.next_tab()
+                wait = max(0, tab.next_due - time.monotonic())
+                await self.browser_call(self.switch_to_tab, tab)
+                timer = TickTimer()
+                
+                # Пауза: в режиме наблюдателя — ожидание очереди на странице, иначе — просто сон
+                timer.start("sleep")
+                observed = None
+                if CAPTURE_MODE == "observer":
+                    observed = await self.wait_observed_messages(wait)
+                else:
+                    await asyncio.sleep(wait)
+                
+                timer.start("extract")
+                await self.browser_call(self.run_tick, tab, observed, timer)
+                
+                # Такт прошел без исключений: считаем ошибки только подряд
+                error_count = 0
+                
+            except Exception as e:
+                error_msg = f"Ошибка в основном цикле: {e}"
+                logger.error(error_msg)
+                error_count += 1
+                await asyncio.sleep(ERROR_RETRY_DELAY)
+    
+    def run_tick(self, tab, observed, timer):
+        """Работа такта после паузы, одной командой в поток браузера: извлечение, обработка, обновление"""
+        tick_started = time.monotonic()
+        messages = self.collect_messages(observed)
+        if self.snapshot_recorder and self.snapshot_recorder.due():
+            timer.start("record")
+            self.snapshot_recorder.record(tab.url, self.driver.page_source, messages)
         
-        # Открываем MAX для входа
-        if not self.open_max():
-            self.forwarding_active = False
-            return
+        new_count = self.process_group_messages(tab, messages, timer)
         
-        self.send_admin_message("🔐 Браузер открыт. Войдите в MAX вручную и нажмите кнопку 'Я вошел' в меню бота.")
+        # Периодически переотправляем то, что не ушло из-за сбоев Telegram
+        if time.monotonic() - self.last_outbox_replay >= OUTBOX_RETRY_INTERVAL:
+            timer.start("send")
+            self.replay_outbox()
         
-        # Ждем готовности через флаг is_ready
-        while not self.is_ready and self.forwarding_active:
-            time.sleep(5)
+        # Обновление страницы только по признакам деградации (память, DOM, возраст, ошибки)
+        timer.start("refresh")
+        refresh_reason = tab.refresh_policy.should_refresh(self.driver)
+        if refresh_reason:
+            self.refresh_page(refresh_reason)
+        timer.stop()
         
-        if not self.forwarding_active:
-            return
+        delay = tab.scheduler.record_tick(time.monotonic() - tick_started, new_count)
+        tab.next_due = time.monotonic() + delay
+        self.record_tick_timing(tab, timer)
+        return new_count
+    
+    def record_tick_timing(self, tab, timer):
+        """Учет этапов такта в статистике и запись в лог медленного такта"""
+        self.stage_stats.record(timer)
+        threshold = self.settings.settings.get("slow_tick_seconds", SLOW_TICK_SECONDS)
+        if threshold and timer.work_time > threshold:
+            self.stage_stats.slow_ticks += 1
+            logger.warning(f"Медленный такт {tab.url}: {timer.work_time * 1000:.0f} мс ({timer.format()})")
+    
+    def process_group_messages(self, tab, messages, timer=None):
+        """Дедупликация сообщений группы, запись в журнал и передача на отправку; возвращает число новых"""
+        timer = timer or TickTimer()
+        timer.start("dedup")
+        # Маршруты из настроек; без них — все чаты-получатели группы
+        route_matcher = self.settings.get_route_matcher()
+        if not route_matcher:
+            target_chats = self.settings.get_group_targets(tab.url)
+            if not target_chats:
+                logger.warning(f"Не выбран чат для отправки из группы {tab.url}")
+                return 0
+            default_deliveries = [(chat_id, FORWARD_PREFIX) for chat_id in target_chats]
         
-        # Переходим в группу
-        if not self.navigate_to_group():
-            self.forwarding_active = False
-            return
+        # Рассматриваем только сообщения после курсора и из них только новые
+        cursor = self.settings.get_cursor(tab.url)
+        candidates = self.select_messages_after_cursor(messages, cursor)
+        CANDIDATES_PER_TICK.observe(len(candidates))
+        # Хеш считается один раз, дедупликация — отдельно для каждого получателя
+        new_messages = []
+        # В историю хеши попадают только после журнала: повторы внутри такта (пузырь и его
+        # текстовый узел из одного сканирования) отсекаются отдельно
+        seen = set()
+        dedup_hits = 0
+        for message in candidates:
+            timer.start("hash")
+            msg_hash = self.get_message_hash(message)
+            timer.start("dedup")
+            deliveries = route_matcher.match(tab.url, message) if route_matcher else default_deliveries
+            for target_chat, prefix in deliveries:
+                dedup_key = self.dedup_key(target_chat, tab)
+                if (dedup_key, msg_hash) not in seen and not self.is_forwarded_before(dedup_key, message, msg_hash):
+                    seen.add((dedup_key, msg_hash))
+                    new_messages.append((target_chat, message["text"], msg_hash, prefix, dedup_key))
+                else:
+                    dedup_hits += 1
+        DEDUP_HITS.inc(dedup_hits)
+        DEDUP_MISSES.inc(len(new_messages))
         
-        # Начинаем пересылку
-        self.send_admin_message("🚀 Начата пересылка сообщений из MAX!")
-        logger.info("Начата пересылка сообщений")
+        # Сначала журнал (fsync), потом отметка об обработке: сообщение не потеряется при падении
+        timer.start("persist")
+        entries = self.outbox.append(new_messages)
+        for _, _, msg_hash, _, dedup_key in new_messages:
+            self.settings.add_processed_message(dedup_key, msg_hash)
         
-        error_count = 0
+        identified = [message for message in candidates if is_identified(message)]
+        if identified:
+            last_message = identified[-1]
+            self.settings.set_cursor(tab.url, {
+                "hash": self.get_message_hash(last_message),
+                "id": last_message["id"],
+                "ts": last_message["ts"]
+            })
         
-        try:
-            while self.forwarding_active:
-                try:
-                    # Получаем сообщения из MAX
-                    messages = self.extract_messages_from_max()
-                    
-                    # Получаем выбранный чат
-                    selected_chat = self.settings.settings.get("selected_chat_id")
-                    if not selected_chat:
-                        logger.warning("Не выбран чат для отправки")
-                        time.sleep(10)
-                        continue
-                    
-                    # Обрабатываем только новые сообщения
-                    new_messages = []
-                    for message in messages:
-                        msg_hash = self.get_message_hash(message)
-                        if not self.settings.is_message_processed(selected_chat, msg_hash):
-                            new_messages.append(message)
-                            self.settings.add_processed_message(selected_chat, msg_hash)
-                    
-                    # Отправляем новые сообщения в Telegram
-                    for message in new_messages:
-                        if len(message) > 4000:
-                            message = message[:4000] + "..."
-                            
-                        success = self.send_to_telegram(f"📨 Из MAX:\n{message}")
-                        if success:
-                            global TOTAL_FORWARDED_MESSAGES
-                            TOTAL_FORWARDED_MESSAGES += 1
-                            logger.info(f"Переслано в {selected_chat}: {message[:80]}...")
-                        else:
-                            logger.error("Ошибка отправки в Telegram")
-                            error_count += 1
-                    
-                    # Сбрасываем счетчик ошибок при успешной отправке
-                    if new_messages:
-                        error_count = 0
-                    
-                    # Перезапуск при множественных ошибках
-                    if error_count >= 5:
-                        self.send_admin_message("⚠️ Много ошибок, перезапускаю браузер...")
-                        self.driver.quit()
-                        time.sleep(5)
-                        if not self.setup_selenium() or not self.navigate_to_group():
-                            self.send_admin_message("❌ Не удалось восстановить соединение")
-                            break
-                        error_count = 0
-                    
-                    # Обновление страницы
-                    if len(messages) % 30 == 0:
-                        self.driver.refresh()
-                        time.sleep(5)
-                    
-                    time.sleep(5)
-                    
-                except Exception as e:
-                    error_msg = f"Ошибка в основном цикле: {e}"
-                    logger.error(error_msg)
-                    error_count += 1
-                    time.sleep(5)
-                    
-        except Exception as e:
-            error_msg = f"Критическая ошибка: {e}"
-            logger.error(error_msg)
-            self.send_admin_message(f"❌ {error_msg}")
-        finally:
-            if self.driver:
-                self.driver.quit()
-            self.forwarding_active = False
-            self.send_admin_message("🛑 Пересылка сообщений остановлена")
+        # Передаем новые сообщения на склейку и в очередь отправки
+        # (лимиты и 429 обрабатывает очередь, длину сообщения — склейка)
+        timer.start("send")
+        for entry in self.outbox.claim(entries):
+            self._dispatch_outbox_entry(entry)
+        
+        timer.stop()
+        tab.forwarded += len(entries)
+        return len(entries)
+    
+    def _dispatch_outbox_entry(self, entry):
+        """Передача записи журнала на склейку и отправку"""
+        future = self.coalescer.add(entry["chat_id"], entry["text"], entry.get("prefix"))
+        future.add_done_callback(lambda done: self._on_forward_result(entry, done.result()))
+    
+    def replay_outbox(self):
+        """Переотправка неподтвержденных записей журнала по порядку (с общими лимитами очереди)"""
+        self.last_outbox_replay = time.monotonic()
+        entries = self.outbox.take_pending()
+        if entries:
+            logger.info(f"Переотправка из журнала: {len(entries)} сообщений")
+        for entry in entries:
+            self._dispatch_outbox_entry(entry)
+    
+    def _on_forward_result(self, entry, result):
+        """Учет результата отправки пересланного сообщения (вызывается потоком очереди)"""
+        chat_id, text = entry["chat_id"], entry["text"]
+        if result:
+            global TOTAL_FORWARDED_MESSAGES
+            TOTAL_FORWARDED_MESSAGES += 1
+            FORWARDED_MESSAGES.inc()
+            released = self.outbox.ack(entry["id"])
+            logger.info(f"Переслано в {chat_id}: {text[:80]}...")
+        elif result.error_code in (400, 403):
+            # Telegram отклонил сообщение окончательно: повтор не поможет
+            released = self.outbox.ack(entry["id"])
+            logger.error(f"Сообщение отклонено Telegram ({chat_id}): {result.error_code} {result.description}")
+        else:
+            released = False
+            self.outbox.release(entry["id"])
+            logger.error(f"Ошибка отправки в Telegram ({chat_id}), повтор позже: {result.error_code} {result.description}")
+        if released:
+            # Первое неотправленное сообщение чата дошло: досылаем придержанные за ним
+            # (в отдельном потоке: обратный вызов может выполняться в event loop бота)
+            threading.Thread(target=self.replay_outbox, name="outbox-replay", daemon=True).start()
     
     def stop_forwarding(self):
-        """Остановка пересылки сообщений"""
+        """Остановка пересылки: мгновенная отмена задачи (браузер закрывает сама задача)"""
         self.forwarding_active = False
         self.is_ready = False
-        if self.driver:
-            self.driver.quit()
+        task, loop = self.task, self._task_loop
+        if task and not task.done() and loop and not loop.is_closed():
+            loop.call_soon_threadsafe(task.cancel)
 
 # Глобальные объекты
 bot_settings = BotSettings()
@@ -377,6 +2644,35 @@ forwarder = MaxToTelegramForwarder(bot_settings)
 # Словарь для временных сессий (user_id -> время авторизации)
 user_sessions = {}
 
+# Фоновые замеры ресурсов для панели производительности
+metrics_sampler = MetricsSampler()
+event_loop_lag_task = None  # задача замера опоздания цикла событий (создается в post_init)
+
+# Метрики, которые читаются из объектов при опросе экспортера
+METRICS.gauge("maxtg_outbound_queue_depth", "Сообщений в очереди отправки", lambda: forwarder.outbound.depth)
+METRICS.gauge("maxtg_outbox_pending", "Записей журнала без подтверждения Telegram",
+              lambda: forwarder.outbox.get_stats()["pending"])
+METRICS.gauge("maxtg_processed_messages", "Хешей обработанных сообщений: загруженных из истории при запуске и добавленных после", lambda: bot_settings.processed_total)
+METRICS.gauge("maxtg_forwarding_active", "Пересылка запущена (1/0)", lambda: int(forwarder.forwarding_active))
+
+async def monitor_event_loop_lag(interval=EVENT_LOOP_LAG_INTERVAL):
+    """Измерение опоздания цикла событий: насколько позже срока просыпается sleep"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - started - interval))
+
+def format_target_chats():
+    """Строка статуса со списком чатов-получателей"""
+    target_chats = bot_settings.get_target_chats()
+    if not target_chats:
+        return "📱 Чат не выбран\n"
+    names = [bot_settings.telegram_chats.get(chat_id, "Неизвестно") for chat_id in target_chats]
+    if len(names) == 1:
+        return f"📱 Выбранный чат: {names[0]}\n"
+    return f"📱 Чаты-получатели ({len(names)}): {', '.join(names)}\n"
+
 def is_user_authorized(user_id):
     """Проверка авторизации пользователя (сессия 1 час)"""
     if user_id in user_sessions:
@@ -391,7 +2687,7 @@ def is_user_authorized(user_id):
     return False
 
 def get_system_info():
-    """Получение информации о системе"""
+    """Получение информации о системе (загрузка и память — из последнего фонового замера)"""
     try:
         # Информация о системе
         system_info = {
@@ -403,93 +2699,88 @@ def get_system_info():
             "python_version": platform.python_version()
         }
         
+        # До первого замера берем мгновенные значения (без ожидания)
+        latest = metrics_sampler.get_latest()
+        if not latest:
+            memory = psutil.virtual_memory()
+            disk = psutil.disk_usage('/')
+            latest = {
+                "memory_total": memory.total, "memory_used": memory.used, "memory_percent": memory.percent,
+                "disk_total": disk.total, "disk_used": disk.used, "disk_percent": disk.percent,
+                "cpu_percent": psutil.cpu_percent(interval=None)
+            }
+        
         # Информация о памяти
-        memory = psutil.virtual_memory()
-        system_info["memory_total"] = memory.total // (1024**3)  # GB
-        system_info["memory_used"] = memory.used // (1024**3)    # GB
-        system_info["memory_percent"] = memory.percent
+        system_info["memory_total"] = latest["memory_total"] // (1024**3)  # GB
+        system_info["memory_used"] = latest["memory_used"] // (1024**3)    # GB
+        system_info["memory_percent"] = latest["memory_percent"]
         
         # Информация о диске
-        disk = psutil.disk_usage('/')
-        system_info["disk_total"] = disk.total // (1024**3)      # GB
-        system_info["disk_used"] = disk.used // (1024**3)        # GB
-        system_info["disk_percent"] = disk.percent
+        system_info["disk_total"] = latest["disk_total"] // (1024**3)      # GB
+        system_info["disk_used"] = latest["disk_used"] // (1024**3)        # GB
+        system_info["disk_percent"] = latest["disk_percent"]
         
         # Информация о CPU
         system_info["cpu_cores"] = psutil.cpu_count()
-        system_info["cpu_usage"] = psutil.cpu_percent(interval=1)
+        system_info["cpu_usage"] = latest["cpu_percent"]
         
         return system_info
     except Exception as e:
         logger.error(f"Ошибка получения информации о системе: {e}")
         return None
 
+def measure_ping():
+    """Время ответа ya.ru"""
+    start_time = time.time()
+    try:
+        requests.get("https://ya.ru", timeout=PROBE_TIMEOUT)
+        ping_time = (time.time() - start_time) * 1000  # в миллисекундах
+        return {"ping": f"{ping_time:.2f} мс"}
+    except Exception as e:
+        return {"ping": f"Ошибка: {str(e)}"}
+
+def measure_download_speed():
+    """Скорость загрузки страницы ya.ru"""
+    start_time = time.time()
+    try:
+        response = requests.get("https://ya.ru", timeout=PROBE_TIMEOUT)
+        download_time = time.time() - start_time
+        # Размер контента в байтах
+        content_size = len(response.content)
+        # Скорость в Mbps (мегабит в секунду)
+        speed_mbps = (content_size * 8) / (download_time * 1_000_000)
+        return {"download_speed": f"{speed_mbps:.2f} Mbps", "upload_speed": "N/A"}
+    except Exception as e:
+        return {"download_speed": f"Ошибка: {str(e)}", "upload_speed": "N/A"}
+
 def test_ping_and_speed():
     """Тестирование пинга и скорости через ya.ru"""
+    results = measure_ping()
+    results.update(measure_download_speed())
+    return results
+
+def get_host_info():
+    """Имя хоста и внутренний IP"""
+    hostname = socket.gethostname()
     try:
-        results = {
-            "ping": "Ошибка",
-            "download_speed": "Ошибка",
-            "upload_speed": "N/A"
-        }
-        
-        # Тестируем пинг до ya.ru
-        start_time = time.time()
-        try:
-            response = requests.get("https://ya.ru", timeout=10)
-            ping_time = (time.time() - start_time) * 1000  # в миллисекундах
-            results["ping"] = f"{ping_time:.2f} мс"
-        except Exception as e:
-            results["ping"] = f"Ошибка: {str(e)}"
-        
-        # Тестируем скорость загрузки через ya.ru
-        start_time = time.time()
-        try:
-            response = requests.get("https://ya.ru", timeout=10)
-            download_time = time.time() - start_time
-            # Размер контента в байтах
-            content_size = len(response.content)
-            # Скорость в Mbps (мегабит в секунду)
-            speed_mbps = (content_size * 8) / (download_time * 1_000_000)
-            results["download_speed"] = f"{speed_mbps:.2f} Mbps"
-        except Exception as e:
-            results["download_speed"] = f"Ошибка: {str(e)}"
-        
-        return results
-    except Exception as e:
-        logger.error(f"Ошибка тестирования скорости и пинга: {e}")
-        return None
+        internal_ip = socket.gethostbyname(hostname)
+    except Exception:
+        internal_ip = "Не удалось определить"
+    return {"hostname": hostname, "internal_ip": internal_ip}
+
+def get_external_ip():
+    """Внешний IP"""
+    try:
+        return {"external_ip": requests.get('https://api.ipify.org', timeout=PROBE_TIMEOUT).text}
+    except Exception:
+        return {"external_ip": "Не удалось определить"}
 
 def get_network_info():
     """Получение информации о сети"""
     try:
-        network_info = {}
-        
-        # Внутренний IP
-        hostname = socket.gethostname()
-        network_info["hostname"] = hostname
-        try:
-            internal_ip = socket.gethostbyname(hostname)
-            network_info["internal_ip"] = internal_ip
-        except:
-            network_info["internal_ip"] = "Не удалось определить"
-        
-        # Внешний IP
-        try:
-            external_ip = requests.get('https://api.ipify.org', timeout=10).text
-            network_info["external_ip"] = external_ip
-        except:
-            network_info["external_ip"] = "Не удалось определить"
-        
-        # Тестируем пинг и скорость через ya.ru
-        speed_test_results = test_ping_and_speed()
-        if speed_test_results:
-            network_info.update(speed_test_results)
-        else:
-            network_info["ping"] = "Ошибка тестирования"
-            network_info["download_speed"] = "Ошибка тестирования"
-            network_info["upload_speed"] = "N/A"
-        
+        network_info = get_host_info()
+        network_info.update(get_external_ip())
+        network_info.update(test_ping_and_speed())
         return network_info
     except Exception as e:
         logger.error(f"Ошибка получения информации о сети: {e}")
@@ -510,7 +2801,19 @@ def get_bot_performance():
             "is_ready": forwarder.is_ready,
             "total_chats": len(bot_settings.telegram_chats),
             "selected_chat": bot_settings.settings.get("selected_chat_id"),
-            "processed_messages_total": sum(len(messages) for messages in bot_settings.processed_messages.values())
+            "processed_messages_total": bot_settings.processed_total,
+            "poll": forwarder.poll_scheduler.get_stats(),
+            "page": forwarder.refresh_policy.get_stats(),
+            "groups": [
+                {"url": tab.url, "forwarded": tab.forwarded, "interval": tab.scheduler.interval,
+                 "refresh_count": tab.refresh_policy.refresh_count}
+                for tab in forwarder.tabs
+            ],
+            "outbound": forwarder.outbound.get_stats(),
+            "coalesce": forwarder.coalescer.get_stats(),
+            "outbox": forwarder.outbox.get_stats(),
+            "stages": forwarder.stage_stats.get_stats(),
+            "resources": metrics_sampler.get_stats()
         }
         
         return performance_info
@@ -551,7 +2854,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Проверяем авторизацию для админских функций
     if data in ["admin_menu", "start_forwarding", "stop_forwarding", "list_chats", 
-                "add_chat", "select_chat", "im_ready", "performance", "logout"]:
+                "add_chat", "select_chat", "im_ready", "performance", "logout",
+                "poll_settings", "routes"] or data.startswith("poll_set_") or data.startswith("chat_") \
+            or data.startswith("route_del_"):
         if not is_user_authorized(user_id):
             await query.edit_message_text(
                 "❌ Доступ запрещен. Требуется авторизация.\n"
@@ -586,6 +2891,14 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await performance_handler(query, user_id)
     elif data == "logout":
         await logout_handler(query, user_id)
+    elif data == "poll_settings":
+        await poll_settings_handler(query, user_id)
+    elif data.startswith("poll_set_"):
+        await poll_set_handler(query, user_id, data)
+    elif data == "routes":
+        await routes_handler(query, user_id)
+    elif data.startswith("route_del_"):
+        await route_delete_handler(query, user_id, data)
     elif data.startswith("chat_"):
         await chat_selection_handler(query, data)
 
@@ -619,13 +2932,8 @@ async def status_handler(query, user_id):
     else:
         status_text += "🔴 Пересылка не активна\n"
     
-    # Выбранный чат
-    selected_chat = bot_settings.settings.get("selected_chat_id")
-    if selected_chat:
-        chat_name = bot_settings.telegram_chats.get(str(selected_chat), "Неизвестно")
-        status_text += f"📱 Выбранный чат: {chat_name}\n"
-    else:
-        status_text += "📱 Чат не выбран\n"
+    # Чаты-получатели
+    status_text += format_target_chats()
     
     # Количество чатов
     status_text += f"💬 Всего чатов: {len(bot_settings.telegram_chats)}\n"
@@ -666,7 +2974,9 @@ async def help_handler(query, user_id):
         "/start - Главное меню\n"
         "/password <пароль> - Авторизация\n"
         "/addchat - Добавить текущий чат\n"
+        "/route <группа|*> <чат|here> [author=...] [keyword=...] [prefix=...] - Добавить маршрут\n"
         "/status - Статус бота\n"
+        "/perfdump [slow <сек>] - Время этапов такта\n"
         "/logout - Выйти из системы"
     )
     
@@ -681,17 +2991,69 @@ async def help_handler(query, user_id):
     
     await query.edit_message_text(help_text, reply_markup=reply_markup)
 
-async def performance_handler(query, user_id):
-    """Обработчик производительности"""
-    # Отправляем сообщение о сборе информации
-    await query.edit_message_text("📊 Сбор информации о производительности...")
-    
-    # Собираем информацию
-    system_info = get_system_info()
-    network_info = get_network_info()
-    performance_info = get_bot_performance()
-    
-    # Формируем сообщение
+# Проверки панели производительности: ключ -> (функция, поля результата)
+PERFORMANCE_PROBES = {
+    "system": (get_system_info, None),
+    "host": (get_host_info, ["hostname", "internal_ip"]),
+    "external_ip": (get_external_ip, ["external_ip"]),
+    "ping": (measure_ping, ["ping"]),
+    "download": (measure_download_speed, ["download_speed", "upload_speed"])
+}
+
+# Метрики истории ресурсов: ключ -> (подпись, единицы)
+RESOURCE_LABELS = [
+    ("cpu_percent", "CPU хоста", "%"),
+    ("bot_cpu_percent", "CPU бота", "%"),
+    ("bot_rss_mb", "Память бота", " МБ"),
+    ("browser_cpu_percent", "CPU браузера", "%"),
+    ("browser_rss_mb", "Память браузера", " МБ"),
+    ("disk_percent", "Диск", "%"),
+    ("net_recv_kbps", "Сеть ↓", " КБ/с"),
+    ("net_sent_kbps", "Сеть ↑", " КБ/с")
+]
+
+# Подписи этапов такта
+STAGE_LABELS = {
+    "tick": "Такт целиком",
+    "sleep": "Пауза",
+    "extract": "Извлечение",
+    "record": "Запись снимка",
+    "hash": "Хеширование",
+    "dedup": "Дедупликация",
+    "persist": "Запись",
+    "send": "Передача на отправку",
+    "refresh": "Проверка обновления"
+}
+
+def format_stages(stages):
+    """Перцентили этапов такта в миллисекундах"""
+    if not stages:
+        return ""
+    text = "\n⏱️ Этапы такта (p50/p95/p99, мс):\n"
+    for stage in ["tick"] + TICK_STAGES:
+        if stage in stages:
+            stage_stats = stages[stage]
+            text += (f"• {STAGE_LABELS[stage]}: {stage_stats['p50'] * 1000:.1f}/"
+                     f"{stage_stats['p95'] * 1000:.1f}/{stage_stats['p99'] * 1000:.1f}\n")
+    return text
+
+def format_resources(resources):
+    """История ресурсов: мин/сред/макс и тренд"""
+    if not resources["samples"]:
+        return "• История ресурсов: первый замер еще не готов\n"
+    hours = resources["samples"] * resources["interval"] / 3600
+    text = f"\n📈 Ресурсы за {hours:.1f} ч (мин/сред/макс):\n"
+    latest = resources["latest"]
+    for name, label, unit in RESOURCE_LABELS:
+        metric = resources["metrics"].get(name)
+        if not metric:
+            continue
+        text += f"• {label}: {metric['min']:.0f}/{metric['avg']:.0f}/{metric['max']:.0f}{unit} {metric['trend']}\n"
+    text += f"• Процессов браузера: {latest.get('browser_processes', 0)}\n"
+    return text
+
+def format_performance(system_info, network_info, performance_info, pending_text):
+    """Текст панели производительности; еще не полученные значения заменяются pending_text"""
     performance_text = "🚀 Производительность бота\n\n"
     
     # Информация о системе
@@ -703,19 +3065,18 @@ async def performance_handler(query, user_id):
         performance_text += f"• Память: {system_info['memory_used']}/{system_info['memory_total']} GB ({system_info['memory_percent']}%)\n"
         performance_text += f"• Диск: {system_info['disk_used']}/{system_info['disk_total']} GB ({system_info['disk_percent']}%)\n"
         performance_text += f"• Python: {system_info['python_version']}\n"
+    elif system_info is None:
+        performance_text += f"• {pending_text}\n"
     else:
         performance_text += "• Не удалось получить информацию о системе\n"
     
     performance_text += "\n🌐 Сетевая информация:\n"
-    if network_info:
-        performance_text += f"• Хост: {network_info['hostname']}\n"
-        performance_text += f"• Внутренний IP: {network_info['internal_ip']}\n"
-        performance_text += f"• Внешний IP: {network_info['external_ip']}\n"
-        performance_text += f"• Пинг до Яндекс: {network_info['ping']}\n"
-        performance_text += f"• Скорость загрузки: {network_info['download_speed']}\n"
-        performance_text += f"• Скорость отдачи: {network_info['upload_speed']}\n"
-    else:
-        performance_text += "• Не удалось получить информацию о сети\n"
+    performance_text += f"• Хост: {network_info.get('hostname', pending_text)}\n"
+    performance_text += f"• Внутренний IP: {network_info.get('internal_ip', pending_text)}\n"
+    performance_text += f"• Внешний IP: {network_info.get('external_ip', pending_text)}\n"
+    performance_text += f"• Пинг до Яндекс: {network_info.get('ping', pending_text)}\n"
+    performance_text += f"• Скорость загрузки: {network_info.get('download_speed', pending_text)}\n"
+    performance_text += f"• Скорость отдачи: {network_info.get('upload_speed', pending_text)}\n"
     
     performance_text += "\n🤖 Производительность бота:\n"
     if performance_info:
@@ -725,13 +3086,187 @@ async def performance_handler(query, user_id):
         performance_text += f"• Пересылка: {'активна' if performance_info['forwarding_active'] else 'не активна'}\n"
         performance_text += f"• Готовность: {'да' if performance_info['is_ready'] else 'нет'}\n"
         performance_text += f"• Чатов в базе: {performance_info['total_chats']}\n"
+        poll_stats = performance_info["poll"]
+        performance_text += f"• Интервал опроса: {poll_stats['interval']:.1f} с ({poll_stats['min_interval']:g}–{poll_stats['max_interval']:g} с)\n"
+        if "tick_median" in poll_stats:
+            performance_text += (f"• Такт: медиана {poll_stats['tick_median'] * 1000:.0f} мс, "
+                                 f"p95 {poll_stats['tick_p95'] * 1000:.0f} мс, "
+                                 f"активных {poll_stats['active_ticks']}/{poll_stats['ticks']}\n")
+        if len(performance_info["groups"]) > 1:
+            performance_text += "• Группы MAX:\n"
+            for group in performance_info["groups"]:
+                performance_text += (f"  ◦ {group['url']}: переслано {group['forwarded']}, "
+                                     f"интервал {group['interval']:.1f} с, обновлений {group['refresh_count']}\n")
+        page_stats = performance_info["page"]
+        performance_text += f"• Обновлений страницы: {page_stats['refresh_count']}"
+        if page_stats["last_reason"]:
+            performance_text += f" (последнее: {page_stats['last_reason']})"
+        performance_text += "\n"
+        if "js_heap_mb" in page_stats:
+            performance_text += f"• Страница MAX: куча JS {page_stats['js_heap_mb']:.0f} МБ, узлов DOM {page_stats['dom_nodes']}\n"
+        outbound_stats = performance_info["outbound"]
+        performance_text += (f"• Очередь отправки: {outbound_stats['depth']} (макс. {outbound_stats['max_depth']}), "
+                             f"отправлено {outbound_stats['sent']}, ошибок {outbound_stats['failed']}, 429: {outbound_stats['throttled']}\n")
+        if "wait_avg" in outbound_stats:
+            performance_text += f"• Ожидание в очереди: среднее {outbound_stats['wait_avg']:.1f} с, макс. {outbound_stats['wait_max']:.1f} с\n"
+        for chat_id, chat_stats in outbound_stats["chats"].items():
+            chat_name = bot_settings.telegram_chats.get(chat_id, chat_id)
+            performance_text += (f"  ◦ {chat_name}: отправлено {chat_stats['sent']}, ошибок {chat_stats['failed']}, "
+                                 f"429: {chat_stats['throttled']}, в очереди {outbound_stats['chats_pending'].get(chat_id, 0)}\n")
+        outbox_stats = performance_info["outbox"]
+        if outbox_stats["pending"]:
+            performance_text += f"• Не подтверждено Telegram: {outbox_stats['pending']} (в отправке {outbox_stats['in_flight']}, придержано чатов {outbox_stats['held_chats']})\n"
+        coalesce_stats = performance_info["coalesce"]
+        if coalesce_stats["packets_out"]:
+            performance_text += (f"• Склейка: {coalesce_stats['messages_in']} сообщений в {coalesce_stats['packets_out']} "
+                                 f"(в среднем {coalesce_stats['packing_ratio']:.1f} в одном)\n")
+        performance_text += format_stages(performance_info["stages"])
+        performance_text += format_resources(performance_info["resources"])
     else:
         performance_text += "• Не удалось получить информацию о производительности\n"
     
+    return performance_text
+
+async def performance_handler(query, user_id):
+    """Обработчик производительности.
+    
+    Блокирующие проверки (psutil, HTTP-запросы) выполняются параллельно в потоках,
+    цикл событий остается свободным для других пользователей. Сообщение
+    обновляется по мере готовности результатов, по истечении PROBE_DEADLINE
+    оставшиеся проверки отмечаются как "нет ответа".
+    """
     keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="admin_menu")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.edit_message_text(performance_text, reply_markup=reply_markup)
+    # Счетчики бота читаются из памяти и доступны сразу
+    performance_info = get_bot_performance()
+    system_info = None
+    network_info = {}
+    
+    async def render(pending_text):
+        text = format_performance(system_info, network_info, performance_info, pending_text)
+        try:
+            await query.edit_message_text(text, reply_markup=reply_markup)
+        except BadRequest as e:
+            # Текст мог не измениться, если проверка вернула то же, что было
+            logger.debug(f"Панель производительности не обновлена: {e}")
+    
+    await render("⏳ проверяется...")
+    
+    tasks = {asyncio.create_task(asyncio.to_thread(probe)): key
+             for key, (probe, _) in PERFORMANCE_PROBES.items()}
+    deadline = time.monotonic() + PROBE_DEADLINE
+    pending = set(tasks)
+    while pending:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            key = tasks[task]
+            try:
+                result = task.result()
+            except Exception as e:
+                logger.error(f"Ошибка проверки '{key}': {e}")
+                result = None
+            if key == "system":
+                system_info = result or {}
+            elif result:
+                network_info.update(result)
+            else:
+                network_info.update({field: "Ошибка" for field in PERFORMANCE_PROBES[key][1]})
+        if done and pending:
+            await render("⏳ проверяется...")
+    
+    # Не успевшие к сроку проверки продолжают работу в своих потоках, их результат не нужен
+    for task in pending:
+        task.cancel()
+    if pending and system_info is None:
+        system_info = {}
+    await render("⌛ нет ответа")
+
+# Варианты границ интервала опроса для админ-панели (секунды)
+POLL_MIN_INTERVAL_CHOICES = [0.5, 1, 2, 5]
+POLL_MAX_INTERVAL_CHOICES = [10, 30, 60, 120]
+
+async def poll_settings_handler(query, user_id):
+    """Настройка интервала опроса"""
+    stats = forwarder.poll_scheduler.get_stats()
+    min_interval = bot_settings.settings.get("poll_min_interval", POLL_MIN_INTERVAL)
+    max_interval = bot_settings.settings.get("poll_max_interval", POLL_MAX_INTERVAL)
+    
+    text = "⏱️ Интервал опроса MAX\n\n"
+    text += f"• Минимум (после активности): {min_interval:g} с\n"
+    text += f"• Потолок (при тишине): {max_interval:g} с\n"
+    text += f"• Текущий интервал: {stats['interval']:.1f} с\n"
+    text += f"• Тактов без новых сообщений подряд: {stats['idle_ticks']}\n"
+    if "tick_median" in stats:
+        text += f"• Длительность такта: медиана {stats['tick_median'] * 1000:.0f} мс, p95 {stats['tick_p95'] * 1000:.0f} мс\n"
+        text += f"• Медианная пауза: {stats['delay_median']:.1f} с\n"
+        text += f"• Активных тактов: {stats['active_ticks']} из {stats['ticks']}\n"
+    
+    keyboard = [
+        [InlineKeyboardButton(f"{'✅ ' if value == min_interval else ''}мин {value:g} с", callback_data=f"poll_set_min_{value}")
+         for value in POLL_MIN_INTERVAL_CHOICES],
+        [InlineKeyboardButton(f"{'✅ ' if value == max_interval else ''}макс {value:g} с", callback_data=f"poll_set_max_{value}")
+         for value in POLL_MAX_INTERVAL_CHOICES],
+        [InlineKeyboardButton("🔄 Обновить", callback_data="poll_settings")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="admin_menu")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+async def poll_set_handler(query, user_id, data):
+    """Изменение границы интервала опроса"""
+    _, _, bound, value = data.split("_", 3)
+    bot_settings.settings[f"poll_{bound}_interval"] = float(value)
+    bot_settings.save_settings()
+    await poll_settings_handler(query, user_id)
+
+def format_route(route):
+    """Описание маршрута одной строкой"""
+    targets = ", ".join(bot_settings.telegram_chats.get(str(chat_id), str(chat_id)) for chat_id in route.get("targets", []))
+    text = f"{route.get('source') or '*'} → {targets}"
+    if route.get("authors"):
+        text += f" | авторы: {', '.join(route['authors'])}"
+    if route.get("keywords"):
+        text += f" | слова: {', '.join(route['keywords'])}"
+    if route.get("prefix"):
+        text += f" | префикс: {route['prefix']}"
+    return text
+
+async def routes_handler(query, user_id):
+    """Список маршрутов пересылки"""
+    routes = bot_settings.get_routes()
+    
+    text = "🔀 Маршруты пересылки\n\n"
+    if routes:
+        for index, route in enumerate(routes, 1):
+            text += f"{index}. {format_route(route)}\n"
+    else:
+        text += "Маршрутов нет: сообщения всех групп идут в выбранные чаты.\n"
+    text += (
+        "\nДобавить: /route <группа|*> <чат|here> [author=Имя] [keyword=слово] [prefix=текст]\n"
+        "Ключевое слово ищется целым словом (или фразой) без учета регистра.\n"
+        "Изменения применяются со следующего такта без перезапуска."
+    )
+    
+    keyboard = [[InlineKeyboardButton(f"🗑️ Удалить {index}", callback_data=f"route_del_{index - 1}")]
+                for index in range(1, len(routes) + 1)]
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="admin_menu")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+async def route_delete_handler(query, user_id, data):
+    """Удаление маршрута"""
+    index = int(data.replace("route_del_", ""))
+    routes = list(bot_settings.get_routes())
+    if 0 <= index < len(routes):
+        del routes[index]
+        bot_settings.set_routes(routes)
+    await routes_handler(query, user_id)
 
 async def main_menu_handler(query, user_id):
     """Главное меню"""
@@ -764,6 +3299,8 @@ async def admin_menu_handler(query, user_id):
         [InlineKeyboardButton("💬 Управление чатами", callback_data="list_chats")],
         [InlineKeyboardButton("📊 Статус", callback_data="status")],
         [InlineKeyboardButton("🚀 Производительность", callback_data="performance")],
+        [InlineKeyboardButton("⏱️ Интервал опроса", callback_data="poll_settings")],
+        [InlineKeyboardButton("🔀 Маршруты", callback_data="routes")],
         [InlineKeyboardButton("ℹ️ Помощь", callback_data="help")],
         [InlineKeyboardButton("🚪 Выйти", callback_data="logout")],
         [InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu")]
@@ -786,7 +3323,7 @@ async def start_forwarding_handler(query, user_id):
         await query.edit_message_text("❌ Доступ запрещен. Требуется авторизация.")
         return
     
-    if not bot_settings.settings.get("selected_chat_id"):
+    if not bot_settings.get_target_chats():
         keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="admin_menu")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text("❌ Сначала выберите чат для отправки!", reply_markup=reply_markup)
@@ -798,8 +3335,8 @@ async def start_forwarding_handler(query, user_id):
         await query.edit_message_text("ℹ️ Пересылка уже запущена!", reply_markup=reply_markup)
         return
     
-    # Запускаем пересылку в отдельном потоке
-    threading.Thread(target=forwarder.start_forwarding_process, daemon=True).start()
+    # Запускаем пересылку задачей в event loop бота
+    forwarder.start()
     
     keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="admin_menu")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -842,9 +3379,11 @@ async def list_chats_handler(query, user_id):
         await query.edit_message_text("❌ Чаты не добавлены!", reply_markup=reply_markup)
         return
     
+    target_chats = bot_settings.get_target_chats()
     keyboard = []
     for chat_id, chat_name in bot_settings.telegram_chats.items():
-        keyboard.append([InlineKeyboardButton(f"💬 {chat_name}", callback_data=f"chat_{chat_id}")])
+        mark = "✅" if chat_id in target_chats else "💬"
+        keyboard.append([InlineKeyboardButton(f"{mark} {chat_name}", callback_data=f"chat_{chat_id}")])
     
     keyboard.append([InlineKeyboardButton("➕ Добавить текущий чат", callback_data="add_chat")])
     keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="admin_menu")])
@@ -852,7 +3391,7 @@ async def list_chats_handler(query, user_id):
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await query.edit_message_text(
-        "💬 Список чатов:\nВыберите чат для отправки сообщений:",
+        "💬 Список чатов:\nНажмите на чат, чтобы включить или выключить пересылку в него (✅ — получатель):",
         reply_markup=reply_markup
     )
 
@@ -913,17 +3452,20 @@ async def logout_handler(query, user_id):
     )
 
 async def chat_selection_handler(query, data):
-    """Обработчик выбора чата"""
-    chat_id = data.split("_")[1]
+    """Обработчик выбора чата: включение/выключение получателя"""
+    chat_id = data.split("_", 1)[1]
     chat_name = bot_settings.telegram_chats.get(chat_id, "Неизвестно")
     
-    bot_settings.settings["selected_chat_id"] = chat_id
-    bot_settings.save_settings()
+    enabled = bot_settings.toggle_target_chat(chat_id)
     
     keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="list_chats")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.edit_message_text(f"✅ Выбран чат: {chat_name}", reply_markup=reply_markup)
+    if enabled:
+        text = f"✅ Чат добавлен в получатели: {chat_name}"
+    else:
+        text = f"➖ Чат исключен из получателей: {chat_name}"
+    await query.edit_message_text(f"{text}\n\n{format_target_chats()}", reply_markup=reply_markup)
 
 async def password_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /password"""
@@ -988,6 +3530,76 @@ async def addchat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(f"✅ Чат '{chat_title}' добавлен в список!")
 
+async def route_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /route <группа|*> <чат|here> [author=...] [keyword=...] [prefix=...]"""
+    user_id = update.effective_user.id
+    
+    if not is_user_authorized(user_id):
+        await update.message.reply_text("❌ Доступ запрещен. Требуется авторизация.")
+        return
+    
+    try:
+        # shlex — чтобы префиксы и слова с пробелами можно было взять в кавычки
+        args = shlex.split(update.message.text)[1:]
+    except ValueError as e:
+        await update.message.reply_text(f"❌ Не удалось разобрать команду: {e}")
+        return
+    if len(args) < 2:
+        await update.message.reply_text(
+            "Использование: /route <группа|*> <чат|here> [author=Имя] [keyword=слово] [prefix=текст]\n"
+            "Несколько чатов, авторов и слов перечисляются через запятую."
+        )
+        return
+    
+    source, targets, options = args[0], args[1], args[2:]
+    route = {"source": source, "targets": [], "authors": [], "keywords": []}
+    for target in targets.split(","):
+        route["targets"].append(normalize_chat_id(update.message.chat_id if target == "here" else target))
+    for option in options:
+        key, _, value = option.partition("=")
+        if key == "author":
+            route["authors"] += [author.strip() for author in value.split(",") if author.strip()]
+        elif key == "keyword":
+            route["keywords"] += [keyword.strip() for keyword in value.split(",") if keyword.strip()]
+        elif key == "prefix":
+            if utf16_length(html.escape(value, quote=False)) > PREFIX_MAX_LENGTH:
+                await update.message.reply_text(f"❌ Префикс длиннее {PREFIX_MAX_LENGTH} символов")
+                return
+            route["prefix"] = value
+        else:
+            await update.message.reply_text(f"❌ Неизвестный параметр: {option}")
+            return
+    
+    bot_settings.set_routes(bot_settings.get_routes() + [route])
+    await update.message.reply_text(f"✅ Маршрут добавлен: {format_route(route)}")
+
+async def perfdump_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /perfdump [slow <секунды>]: перцентили этапов такта"""
+    user_id = update.effective_user.id
+    
+    if not is_user_authorized(user_id):
+        await update.message.reply_text("❌ Доступ запрещен. Требуется авторизация.")
+        return
+    
+    if len(context.args) == 2 and context.args[0] == "slow":
+        try:
+            threshold = float(context.args[1])
+        except ValueError:
+            await update.message.reply_text("Использование: /perfdump slow <секунды> (0 — не логировать)")
+            return
+        bot_settings.settings["slow_tick_seconds"] = threshold
+        bot_settings.save_settings()
+        await update.message.reply_text(f"✅ Порог медленного такта: {threshold:g} с")
+        return
+    
+    stages = forwarder.stage_stats.get_stats()
+    text = format_stages(stages) or "Нет данных: пересылка еще не выполнила ни одного такта."
+    threshold = bot_settings.settings.get("slow_tick_seconds", SLOW_TICK_SECONDS)
+    text += f"\nПорог медленного такта: {f'{threshold:g} с' if threshold else 'выключен'}"
+    text += f", медленных тактов: {forwarder.stage_stats.slow_ticks}\n"
+    text += "\n" + json.dumps(stages, ensure_ascii=False)
+    await update.message.reply_text(text.strip())
+
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /status"""
     user_id = update.effective_user.id
@@ -1006,13 +3618,8 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         status_text += "🔴 Пересылка не активна\n"
     
-    # Выбранный чат
-    selected_chat = bot_settings.settings.get("selected_chat_id")
-    if selected_chat:
-        chat_name = bot_settings.telegram_chats.get(str(selected_chat), "Неизвестно")
-        status_text += f"📱 Выбранный чат: {chat_name}\n"
-    else:
-        status_text += "📱 Чат не выбран\n"
+    # Чаты-получатели
+    status_text += format_target_chats()
     
     await update.message.reply_text(status_text)
 
@@ -1026,7 +3633,24 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     bot_settings.save_settings()
     
     # Отправляем админу
-    forwarder.send_admin_message(f"❌ {error_msg}")
+    await forwarder.send_admin_message_async(f"❌ {error_msg}")
+
+async def post_init(application: Application):
+    """Подключение отправителя к боту и event loop приложения"""
+    global event_loop_lag_task
+    forwarder.sender.attach(application.bot, asyncio.get_running_loop())
+    # Не application.create_task: задача бесконечна, ее отменяет post_stop
+    event_loop_lag_task = asyncio.create_task(monitor_event_loop_lag(), name="event-loop-lag")
+    # Досылаем сообщения, не подтвержденные до перезапуска (в фоне: очередь может быть заполнена)
+    threading.Thread(target=forwarder.replay_outbox, name="outbox-replay", daemon=True).start()
+
+async def post_stop(application: Application):
+    """Остановка пересылки вместе с ботом: задача отменяется, браузер закрывается"""
+    task = forwarder.task
+    forwarder.stop_forwarding()
+    if event_loop_lag_task:
+        event_loop_lag_task.cancel()
+    await asyncio.gather(*(t for t in (task, event_loop_lag_task) if t and not t.done()), return_exceptions=True)
 
 def main():
     """Основная функция"""
@@ -1039,7 +3663,14 @@ def main():
         print("⚠️  Для полной функциональности установите: pip install psutil")
     
     # Создаем приложение
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .connection_pool_size(SEND_POOL_SIZE)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .build()
+    )
     forwarder.application = application
     
     # Добавляем обработчики
@@ -1047,6 +3678,8 @@ def main():
     application.add_handler(CommandHandler("password", password_command))
     application.add_handler(CommandHandler("logout", logout_command))
     application.add_handler(CommandHandler("addchat", addchat_command))
+    application.add_handler(CommandHandler("route", route_command))
+    application.add_handler(CommandHandler("perfdump", perfdump_command))
     application.add_handler(CommandHandler("status", status_command))
     application.add_handler(CallbackQueryHandler(button_handler))
     application.add_error_handler(error_handler)
@@ -1057,7 +3690,14 @@ def main():
     print("🔐 Безопасность: доступ к админ-панели только по паролю с сессией 1 час")
     print("🚪 Команда /logout для выхода из системы")
     
-    application.run_polling()
+    metrics_sampler.start()
+    start_metrics_server()
+    
+    try:
+        application.run_polling()
+    finally:
+        # Дописываем на диск все отложенные изменения
+        bot_settings.close()
 
 if __name__ == "__main__":
     main()